@@ -0,0 +1,71 @@
+"""Adding users to DataWolf, with a new connection per call (urllib) and with the pooled client.
+
+DataWolf is replaced by a local stub, which can answer slowly (--delay) or fail (--fail), in which case
+the circuit breaker of the pooled client is shown. Run from the repository root:
+
+    python benchmarks/bench_datawolf.py --calls 2000
+    python benchmarks/bench_datawolf.py --calls 200 --fail 500
+    python benchmarks/bench_datawolf.py --calls 200 --delay 0.5 --read-timeout 0.1
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+from synthetic import StubServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "incore_auth"))
+from datawolf import DataWolfClient  # noqa: E402
+
+
+def call_urllib(url, i, timeout):
+    query = urllib.parse.urlencode({"firstname": "User", "lastname": str(i), "email": f"user{i}@example.com"})
+    request = urllib.request.Request(f"{url}/persons?{query}", method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
+
+
+def call_client(client, i):
+    return client.add_person("User", str(i), f"user{i}@example.com")
+
+
+def run(name, call, calls):
+    results = {}
+    start = time.perf_counter()
+    for i in range(calls):
+        try:
+            result = str(call(i))
+        except Exception as e:
+            result = type(e).__name__
+        results[result] = results.get(result, 0) + 1
+    elapsed = time.perf_counter() - start
+    return {"name": name, "calls": calls, "elapsed_s": elapsed, "per_call_ms": elapsed / calls * 1000,
+            "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds the stub waits before answering")
+    parser.add_argument("--fail", type=int, default=0, help="status the stub answers with, e.g. 500")
+    parser.add_argument("--read-timeout", type=float, default=10)
+    parser.add_argument("--threshold", type=int, default=5, help="failures before the circuit opens")
+    args = parser.parse_args()
+
+    stub = StubServer(status=args.fail or 200, delay=args.delay)
+    url = stub.url + "/datawolf"
+    client = DataWolfClient(url, pool_size=1, read_timeout=args.read_timeout, failure_threshold=args.threshold)
+
+    report = {"parameters": vars(args), "results": []}
+    report["results"].append(run("urllib", lambda i: call_urllib(url, i, args.read_timeout), args.calls))
+    report["results"].append(run("pooled", lambda i: call_client(client, i), args.calls))
+    report["client"] = client.stats()
+    report["stub_requests"] = stub.requests
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
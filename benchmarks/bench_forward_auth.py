@@ -0,0 +1,210 @@
+"""Throughput and latency of the forward auth check on a mix of requests.
+
+Runs verify_token through the Flask test client (client) and through gunicorn with the gevent worker
+from gunicorn.config.py (gunicorn). InfluxDB and DataWolf are replaced by local stubs, mongo is
+not used, so this runs offline. Results are printed as json, use --output to compare across commits.
+Run from the repository root:
+
+    python benchmarks/bench_forward_auth.py --mode both --requests 5000 --output results.json
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from synthetic import AUDIENCE, StubServer, Workload, make_keypair
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+APP_DIR = os.path.join(ROOT, "incore_auth")
+
+
+def percentiles(timings):
+    """Return count, p50 and p99 (in milliseconds) of the timings (in seconds)"""
+    if not timings:
+        return {"count": 0}
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "p50_ms": timings[len(timings) // 2] * 1000,
+        "p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+    }
+
+
+def summarize(mode, results, elapsed, statuses):
+    """Turn [(kind, seconds)] into the json report"""
+    kinds = sorted({kind for kind, _ in results})
+    return {
+        "mode": mode,
+        "requests": len(results),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(results) / elapsed if elapsed else 0.0,
+        "latency": dict(
+            [("all", percentiles([seconds for _, seconds in results]))] +
+            [(kind, percentiles([seconds for k, seconds in results if k == kind])) for kind in kinds]
+        ),
+        "statuses": statuses,
+    }
+
+
+def environment(public_key, influxdb, datawolf, extra=None):
+    env = dict(os.environ)
+    env.update({
+        "KEYCLOAK_PUBLIC_KEY": public_key,
+        "KEYCLOAK_AUDIENCE": AUDIENCE,
+        "DATAWOLF_URL": datawolf.url + "/datawolf",
+        "INFLUXDB_V2_URL": influxdb.url,
+        "INFLUXDB_V2_ORG": "incore",
+        "INFLUXDB_V2_TOKEN": "benchmark",
+        "MONGODB_URI": "",
+    })
+    env.update(extra or {})
+    return env
+
+
+def run_client(workload, count, env):
+    """Drive verify_token in process through the Flask test client"""
+    os.environ.update(env)
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    import app
+
+    client = app.app.test_client()
+    requests = workload.requests(count)
+    # warm up the caches, the app itself is set up when it is imported
+    for _, headers in requests[:100]:
+        client.get("/", headers=headers)
+
+    results = []
+    statuses = {}
+    start = time.perf_counter()
+    for kind, headers in requests:
+        before = time.perf_counter()
+        status = client.get("/", headers=headers).status_code
+        results.append((kind, time.perf_counter() - before))
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return summarize("client", results, time.perf_counter() - start, statuses)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/healthz")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("gunicorn did not start")
+
+
+def run_gunicorn(workload, count, concurrency, env, workers=None):
+    """Drive verify_token through gunicorn, with concurrency keep-alive connections"""
+    port = free_port()
+    command = [sys.executable, "-m", "gunicorn", "app:app", "--config", "gunicorn.config.py",
+               "--bind", f"127.0.0.1:{port}", "--log-level", "warning"]
+    if workers:
+        command += ["--workers", str(workers)]
+    server = subprocess.Popen(command, cwd=APP_DIR, env=env)
+    try:
+        wait_for(port)
+        requests = workload.requests(count)
+        chunks = [requests[i::concurrency] for i in range(concurrency)]
+        results = []
+        statuses = {}
+        lock = threading.Lock()
+
+        def drive(chunk):
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            local = []
+            for kind, headers in chunk:
+                before = time.perf_counter()
+                conn.request("GET", "/", headers=headers)
+                response = conn.getresponse()
+                response.read()
+                local.append((kind, time.perf_counter() - before))
+                with lock:
+                    statuses[str(response.status)] = statuses.get(str(response.status), 0) + 1
+            with lock:
+                results.extend(local)
+
+        # warm up the caches of every worker, the workers are set up by post_worker_init
+        drive(workload.requests(100))
+        results.clear()
+        statuses.clear()
+
+        threads = [threading.Thread(target=drive, args=(chunk,)) for chunk in chunks]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report = summarize("gunicorn", results, time.perf_counter() - start, statuses)
+        report["concurrency"] = concurrency
+        return report
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["client", "gunicorn", "both"], default="client")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=8, help="connections for gunicorn mode")
+    parser.add_argument("--workers", type=int, default=None, help="gunicorn workers (default from config)")
+    parser.add_argument("--users", type=int, default=100, help="distinct users (tokens)")
+    parser.add_argument("--groups", type=int, default=5, help="groups per token")
+    parser.add_argument("--roles", type=int, default=5, help="roles per token")
+    parser.add_argument("--weights", type=json.loads, default=None,
+                        help='json object, e.g. {"protected": 0.6, "unprotected": 0.2, "tracked": 0.1, "invalid": 0.1}')
+    parser.add_argument("--env", type=json.loads, default=None, help="json object with extra environment variables")
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+
+    private_pem, public_key = make_keypair()
+    workload = Workload(private_pem, args.users, args.groups, args.roles, args.weights)
+    influxdb = StubServer(status=204)
+    datawolf = StubServer(status=200)
+    env = environment(public_key, influxdb, datawolf, args.env)
+
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "mode")},
+        "results": [],
+    }
+    # gunicorn runs first, the client mode imports the app in this process
+    if args.mode in ("gunicorn", "both"):
+        report["results"].append(run_gunicorn(workload, args.requests, args.concurrency, env, args.workers))
+    if args.mode in ("client", "both"):
+        report["results"].append(run_client(workload, args.requests, env))
+    report["stubs"] = {"influxdb_requests": influxdb.requests, "datawolf_requests": datawolf.requests}
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(os.path.join(ROOT, args.output) if not os.path.isabs(args.output) else args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Resident memory per worker and lookup latency for the IP2Location database.
+
+The database is opened before forking the workers (like gunicorn with preload_app), every worker then
+does random lookups and reports its memory use. Run from the repository root:
+
+    python benchmarks/bench_geolocation.py incore_auth/data/IP2LOCATION-LITE-DB5.BIN --workers 4
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "incore_auth"))
+import IP2Location  # noqa: E402
+from geolocation import MappedIP2Location  # noqa: E402
+
+
+def memory():
+    """Return resident and proportional (shared pages divided over processes) memory in kB"""
+    result = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss", "Shared_Clean", "Private_Clean", "Private_Dirty"):
+                result[key.lower()] = int(value.split()[0])
+    return result
+
+
+def worker(database, lookups, seed):
+    rnd = random.Random(seed)
+    ips = [".".join(str(rnd.randint(1, 254)) for _ in range(4)) for _ in range(lookups)]
+    timings = []
+    errors = 0
+    for ip in ips:
+        start = time.perf_counter()
+        try:
+            database.get_all(ip)
+        except Exception:
+            errors += 1
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "errors": errors,
+        "p50_us": timings[len(timings) // 2] * 1e6,
+        "p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+        "memory_kb": memory(),
+    }
+
+
+def run(name, opener, filename, workers, lookups):
+    start = time.perf_counter()
+    database = opener(filename)
+    open_ms = (time.perf_counter() - start) * 1000
+
+    pipes = []
+    for i in range(workers):
+        read_fd, write_fd = os.pipe()
+        if os.fork() == 0:
+            os.close(read_fd)
+            os.write(write_fd, json.dumps(worker(database, lookups, i)).encode())
+            os._exit(0)
+        os.close(write_fd)
+        pipes.append(read_fd)
+
+    results = []
+    for read_fd in pipes:
+        with os.fdopen(read_fd) as f:
+            results.append(json.loads(f.read()))
+        os.wait()
+    return {
+        "mode": name,
+        "open_ms": open_ms,
+        "errors": sum(r["errors"] for r in results),
+        "p50_us": sum(r["p50_us"] for r in results) / workers,
+        "p99_us": max(r["p99_us"] for r in results),
+        "rss_kb_per_worker": sum(r["memory_kb"]["rss"] for r in results) / workers,
+        "pss_kb_per_worker": sum(r["memory_kb"]["pss"] for r in results) / workers,
+        "private_kb_per_worker": sum(r["memory_kb"]["private_clean"] + r["memory_kb"]["private_dirty"]
+                                     for r in results) / workers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("database")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = [
+        run("file_io", lambda f: IP2Location.IP2Location(f, mode="FILE_IO"), args.database, args.workers, args.lookups),
+        run("mmap", MappedIP2Location, args.database, args.workers, args.lookups),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Serializing auth datapoints to line protocol, influxdb_client from dicts versus AuthEncoder.
+
+The dict path is what the influxdb write api does with a list of dicts, Point.from_dict for every
+point followed by joining the lines. Both produce the payload for a batch. The memory allocated while
+encoding a single batch is measured with tracemalloc. Run from the repository root:
+
+    python benchmarks/bench_lineprotocol.py --points 100000 --rate 5000
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from influxdb_client import Point, WritePrecision
+
+from synthetic import auth_datapoint
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "incore_auth"))
+from lineprotocol import AuthEncoder  # noqa: E402
+
+
+def influxdb_client_payload(points):
+    return b"\n".join(Point.from_dict(point, write_precision=WritePrecision.NS).to_line_protocol().encode("utf-8")
+                      for point in points)
+
+
+def measure(name, encode, batches, rate):
+    # memory used by a single batch, after a warm up
+    payload = encode(batches[0])
+    tracemalloc.start()
+    encode(batches[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    points = sum(len(batch) for batch in batches)
+    start = time.perf_counter()
+    for batch in batches:
+        encode(batch)
+    elapsed = time.perf_counter() - start
+    return {
+        "name": name,
+        "points_per_s": points / elapsed,
+        "us_per_point": elapsed / points * 10 ** 6,
+        "cpu_at_rate": rate * elapsed / points,
+        "batch_peak_bytes": peak,
+        "batch_payload_bytes": len(payload),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--points", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--rate", type=int, default=5000, help="peak points per second, for cpu_at_rate")
+    args = parser.parse_args()
+
+    batches = [[auth_datapoint(i) for i in range(start, min(start + args.batch_size, args.points))]
+               for start in range(0, args.points, args.batch_size)]
+    encoder = AuthEncoder()
+    # both produce the same lines, apart from the order of the fields
+    sample = copy.deepcopy(batches[0][:1])
+    assert sorted(encoder.encode(sample).split(b" ")[1].split(b",")) == \
+        sorted(influxdb_client_payload(sample).split(b" ")[1].split(b","))
+
+    print(json.dumps({
+        "parameters": vars(args),
+        "results": [
+            measure("influxdb_client", influxdb_client_payload, batches, args.rate),
+            measure("AuthEncoder", encoder.encode, batches, args.rate),
+        ],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
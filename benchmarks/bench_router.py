@@ -0,0 +1,81 @@
+"""Compare the resource router against the original split based request_resource.
+
+Run from the repository root: python benchmarks/bench_router.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "incore_auth"))
+from policy import compile_policy  # noqa: E402
+
+config = json.load(open(os.path.join(os.path.dirname(__file__), "..", "incore_auth", "config.json")))
+tracked = config["TRACKED_RESOURCES"]
+
+URIS = [
+    "/",
+    "/index.html",
+    "/assets/main.js",
+    "/data/api/datasets?limit=100",
+    "/data/api/datasets/5a284f0bc7d30d13bc081a28/blob",
+    "/dfr3/api/fragilities/5b47b2d7337d4a36187c61c9",
+    "/hazard/api/earthquakes/5b902cb273c3371e1236b36b/values",
+    "/space/api/spaces",
+    "/geoserver/incore/wms?SERVICE=WMS&REQUEST=GetMap",
+    "/geoserver/web/wicket/bookmarkable/org.geoserver.web.demo.MapPreviewPage",
+    "/doc/incore-lab/index.html",
+    "/playbook/galveston/index.html",
+    "/DFR3Viewer/static/js/main.js",
+    "/hub/user/alice/lab",
+]
+
+
+def legacy(uri, request_info):
+    """request_resource as it was before the router"""
+    try:
+        request_info['uri'] = uri
+        pieces = uri.split('/')
+        if len(pieces) == 2:
+            if pieces[1] in tracked:
+                request_info['resource'] = pieces[1]
+            else:
+                request_info['resource'] = "frontpage"
+        else:
+            request_info['resource'] = pieces[1]
+            if request_info['resource'] == "doc" and len(pieces) > 2:
+                request_info['fields']['manual'] = pieces[2]
+            if request_info['resource'] == "playbook" and len(pieces) > 2:
+                request_info['fields']['playbook'] = pieces[2]
+            if request_info['resource'] == "data" and len(pieces) > 4 and uri.endswith('blob'):
+                request_info['fields']['dataset'] = pieces[4]
+            if request_info['resource'] == "dfr3" and len(pieces) > 4:
+                request_info['fields']['fragility'] = pieces[4]
+    except IndexError:
+        request_info['resource'] = 'NA'
+
+
+def main(number=20000):
+    router = compile_policy(config).router
+
+    def run_legacy():
+        for uri in URIS:
+            legacy(uri, {"fields": {}})
+
+    def run_router():
+        for uri in URIS:
+            router.classify(uri, {})
+
+    results = {}
+    for name, func in (("legacy", run_legacy), ("router", run_router)):
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        results[name] = {"ns_per_uri": seconds / (number * len(URIS)) * 1e9}
+    print(json.dumps(results, indent=2))
+
+    for uri in URIS:
+        fields = {}
+        print(f"{router.classify(uri, fields):>15} {fields} {uri}")
+
+
+if __name__ == "__main__":
+    main()
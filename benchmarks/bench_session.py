@@ -0,0 +1,68 @@
+"""Cost of verifying a request, RS256 signature of the token versus the signed session cookie.
+
+Both start from the raw token as it arrives in the Authorization header. The RS256 path is what a
+worker does for a token it has not seen before, the session path is what it does when the request
+also has the session cookie issued for that token. Run from the repository root:
+
+    python benchmarks/bench_session.py --iterations 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from jose import jwk, jwt
+
+from synthetic import AUDIENCE, make_keypair, make_token
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "incore_auth"))
+from session import SessionSigner  # noqa: E402
+from tokencache import token_digest  # noqa: E402
+
+
+def per_call(function, iterations):
+    function()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 10 ** 6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=5, help="groups per token")
+    parser.add_argument("--roles", type=int, default=5, help="roles per token")
+    args = parser.parse_args()
+
+    private_pem, public_key = make_keypair()
+    key = jwk.construct(f"-----BEGIN PUBLIC KEY-----\n{public_key}\n-----END PUBLIC KEY-----", "RS256")
+    token = make_token(private_pem, "user", args.groups, args.roles)
+    signer = SessionSigner("benchmark")
+    claims = jwt.decode(token, key, audience=AUDIENCE)
+    cookie = signer.issue(token_digest(token), claims)
+
+    def rs256():
+        jwt.get_unverified_claims(token)
+        return jwt.decode(token, key, audience=AUDIENCE)
+
+    def session():
+        return signer.verify(cookie, token_digest(token))
+
+    assert session()["preferred_username"] == "user"
+    rs256_us = per_call(rs256, args.iterations)
+    session_us = per_call(session, args.iterations)
+    print(json.dumps({
+        "parameters": vars(args),
+        "token_bytes": len(token),
+        "cookie_bytes": len(cookie),
+        "rs256_us": rs256_us,
+        "session_us": session_us,
+        "issue_us": per_call(lambda: signer.issue(token_digest(token), claims), args.iterations),
+        "speedup": rs256_us / session_us,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
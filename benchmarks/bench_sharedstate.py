@@ -0,0 +1,65 @@
+"""Shared state in process and in redis, and what happens while redis is unavailable.
+
+Redis is replaced by a local stub speaking the redis protocol. The provisioning marker (add) and
+the claims lookup (get) are timed against LocalState and RedisState, then the stub is stopped to
+show the fallback to state local to the worker, and started again. Run from the repository root:
+
+    python benchmarks/bench_sharedstate.py --calls 5000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from synthetic import RedisStub
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "incore_auth"))
+from sharedstate import LocalState, RedisState  # noqa: E402
+
+
+def run(name, state, calls):
+    """Add a provisioning marker for calls users, add them again, and look them up"""
+    keys = [f"provision:{name}:user{i}" for i in range(calls)]
+    start = time.perf_counter()
+    added = sum(state.add(key, 1, 60) for key in keys)
+    again = sum(state.add(key, 1, 60) for key in keys)
+    found = sum(state.get(key) is not None for key in keys)
+    elapsed = time.perf_counter() - start
+    return {"name": name, "calls": 3 * calls, "elapsed_s": elapsed, "per_call_us": elapsed / (3 * calls) * 1e6,
+            "added": added, "added_again": again, "found": found}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--retry-interval", type=float, default=1.0, help="seconds before redis is tried again")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    stub = RedisStub()
+    redis_state = RedisState(stub.url, retry_interval=args.retry_interval)
+
+    report = {"parameters": vars(args), "results": []}
+    report["results"].append(run("local", LocalState(), args.calls))
+    report["results"].append(run("redis", redis_state, args.calls))
+
+    # while redis is down every user is still added once, and requests don't wait for the timeout
+    stub.stop()
+    result = run("redis down", redis_state, args.calls)
+    result["errors"] = redis_state.errors
+    report["results"].append(result)
+
+    stub.start()
+    time.sleep(args.retry_interval)
+    result = run("redis back", redis_state, args.calls)
+    result["available"] = redis_state.available()
+    report["results"].append(result)
+
+    report["stub_commands"] = stub.commands
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
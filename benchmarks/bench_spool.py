@@ -0,0 +1,73 @@
+"""Throughput of the analytics spool, appending datapoints while influxdb is down and replaying them.
+
+Points are appended to a spool in a temporary directory, then replayed without rate limit into a
+local stub standing in for influxdb. Run from the repository root:
+
+    python benchmarks/bench_spool.py --points 200000
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import time
+
+from synthetic import StubServer, auth_datapoint
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "incore_auth"))
+from lineprotocol import AuthEncoder  # noqa: E402
+from spool import Spool, SpoolingSink  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--points", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=500, help="points per analytics batch")
+    parser.add_argument("--segment-mb", type=int, default=8)
+    args = parser.parse_args()
+
+    stub = StubServer(status=204)
+    conn = http.client.HTTPConnection("127.0.0.1", stub.server.server_port)
+
+    def influxdb(payload):
+        conn.request("POST", "/api/v2/write", body=payload)
+        response = conn.getresponse()
+        response.read()
+        if response.status >= 300:
+            raise RuntimeError(response.status)
+
+    def down(points):
+        raise ConnectionError("influxdb is down")
+
+    batches = [[auth_datapoint(i) for i in range(start, min(start + args.batch_size, args.points))]
+               for start in range(0, args.points, args.batch_size)]
+    with tempfile.TemporaryDirectory() as directory:
+        spool = Spool(directory, segment_size=args.segment_mb * 1024 * 1024, max_bytes=10 * 1024 ** 3)
+        sink = SpoolingSink(down, spool, rate=10 ** 9, chunk_size=5000)
+        encoder = AuthEncoder()
+        start = time.perf_counter()
+        for batch in batches:
+            sink(encoder.encode(batch))
+        spool.close_segment()
+        append = time.perf_counter() - start
+        size = spool.stats()["bytes"]
+
+        sink.sink = influxdb
+        start = time.perf_counter()
+        sink.replay()
+        replay = time.perf_counter() - start
+
+    print(json.dumps({
+        "parameters": vars(args),
+        "spool_bytes": size,
+        "bytes_per_point": size / args.points,
+        "append_points_per_s": args.points / append,
+        "replay_points_per_s": args.points / replay,
+        "replayed": sink.replayed,
+        "stub_requests": stub.requests,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Synthetic keys, Keycloak shaped tokens, request mixes and stub services for the benchmarks."""
+import base64
+import random
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+AUDIENCE = "incore-benchmark"
+
+
+def make_keypair():
+    """Return the private key as PEM and the public key as used in KEYCLOAK_PUBLIC_KEY"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()).decode()
+    public_der = key.public_key().public_bytes(serialization.Encoding.DER,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)
+    return private_pem, base64.b64encode(public_der).decode()
+
+
+def make_token(private_pem, username, groups=5, roles=5, lifetime=3600):
+    """Return a signed token with the claims Keycloak puts in an access token"""
+    now = int(time.time())
+    claims = {
+        "exp": now + lifetime,
+        "iat": now,
+        "jti": str(uuid.uuid4()),
+        "iss": "http://localhost/auth/realms/In-core",
+        "aud": AUDIENCE,
+        "sub": str(uuid.uuid4()),
+        "typ": "Bearer",
+        "azp": "react-auth",
+        "session_state": str(uuid.uuid4()),
+        "scope": "openid email profile",
+        "email_verified": True,
+        "name": f"{username.title()} Benchmark",
+        "preferred_username": username,
+        "given_name": username.title(),
+        "family_name": "Benchmark",
+        "email": f"{username}@example.com",
+        "groups": ["incore_user"] + [f"group_{i}" for i in range(groups - 1)],
+        "realm_access": {"roles": ["offline_access", "uma_authorization"] + [f"role_{i}" for i in range(roles)]},
+    }
+    return jwt.encode(claims, private_pem, algorithm="RS256")
+
+
+class Workload:
+    """Mix of forward auth requests as traefik sends them. The weights give the fraction of each
+    kind of request: protected (valid token), unprotected (static content), tracked (analytics)
+    and invalid (bad or expired token on a protected resource)."""
+
+    KINDS = {
+        "protected": ["/data/api/datasets", "/dfr3/api/fragilities/5b47b2d7337d4a36187c61c9",
+                      "/hazard/api/earthquakes", "/space/api/spaces", "/geoserver/incore/wms"],
+        "unprotected": ["/assets/main.js", "/static/css/main.css", "/favicon.ico"],
+        "tracked": ["/doc/incore-lab/index.html", "/playbook/galveston/index.html", "/"],
+        "invalid": ["/data/api/datasets", "/hazard/api/earthquakes"],
+    }
+
+    def __init__(self, private_pem, users=100, groups=5, roles=5, weights=None, seed=0):
+        self.weights = weights or {"protected": 0.6, "unprotected": 0.2, "tracked": 0.1, "invalid": 0.1}
+        self.random = random.Random(seed)
+        self.tokens = [make_token(private_pem, f"user{i}", groups, roles) for i in range(users)]
+        other_pem, _ = make_keypair()
+        self.invalid = [
+            "not.a.token",
+            make_token(private_pem, "expired", groups, roles, lifetime=-60),
+            make_token(other_pem, "forged", groups, roles),
+        ]
+
+    def requests(self, count):
+        """Return a list of (kind, headers)"""
+        kinds = list(self.weights)
+        weights = [self.weights[kind] for kind in kinds]
+        result = []
+        for kind in self.random.choices(kinds, weights, k=count):
+            headers = {
+                "X-Forwarded-Method": "GET",
+                "X-Forwarded-Host": "incore.example.com",
+                "X-Forwarded-Uri": self.random.choice(self.KINDS[kind]),
+                "X-Forwarded-For": f"10.{self.random.randint(0, 255)}.{self.random.randint(0, 255)}.1",
+            }
+            if kind == "invalid":
+                headers["Authorization"] = "Bearer " + self.random.choice(self.invalid)
+            elif kind != "unprotected":
+                headers["Authorization"] = "Bearer " + self.random.choice(self.tokens)
+            result.append((kind, headers))
+        return result
+
+
+def auth_datapoint(i):
+    """Datapoint as created by record_request for a dataset download, after geolocation"""
+    return {
+        "measurement": "auth",
+        "tags": {"server": "incore.example.com", "http_method": "GET", "resource": "data",
+                 "username": f"user{i % 100}", "group": "public", "country_code": "US",
+                 "country": "United States of America", "region": "Illinois", "city": "Urbana"},
+        "fields": {"url": f"/data/api/datasets/{i:024x}/blob", "ip": "10.0.0.1", "elapsed": 0.000123,
+                   "dataset": f"{i:024x}", "latitude": 40.11, "longitude": -88.2, "geohash": "dp1k2"},
+        "time": 1700000000000000000 + i,
+    }
+
+
+class StubServer:
+    """HTTP server standing in for InfluxDB and DataWolf, it answers every request with status
+    after waiting delay seconds and counts the requests."""
+
+    def __init__(self, status=204, delay=0.0):
+        self.status = status
+        self.delay = delay
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections open, like the real services
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.requests += 1
+                if stub.delay:
+                    time.sleep(stub.delay)
+                self.send_response(stub.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+class RedisStub:
+    """TCP server speaking enough of the redis protocol for the shared state: SET (with NX and PX),
+    GET, DEL and DBSIZE. Keys are kept in a dict, it can be stopped and started again on the same
+    port to simulate an outage."""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = 0
+        self.connections = set()
+        self.server = None
+        self.port = 0
+        self.start()
+        self.url = f"redis://127.0.0.1:{self.port}"
+
+    def start(self):
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def command(self):
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                args = []
+                for _ in range(int(line[1:])):
+                    size = int(self.rfile.readline()[1:])
+                    args.append(self.rfile.read(size + 2)[:-2])
+                return args
+
+            def handle(self):
+                stub.connections.add(self.connection)
+                while True:
+                    args = self.command()
+                    if args is None:
+                        return
+                    stub.commands += 1
+                    self.wfile.write(stub.execute(args))
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(("127.0.0.1", self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Stop the server and drop all connections"""
+        self.server.shutdown()
+        self.server.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.connections.clear()
+
+    def execute(self, args):
+        name = args[0].upper()
+        now = time.time()
+        if name == b"SET":
+            options = [arg.upper() for arg in args[3:]]
+            expires = None
+            if b"PX" in options:
+                expires = now + int(args[3 + options.index(b"PX") + 1]) / 1000
+            if b"NX" in options and self._get(args[1], now) is not None:
+                return b"$-1\r\n"
+            self.data[args[1]] = (args[2], expires)
+            return b"+OK\r\n"
+        if name == b"GET":
+            value = self._get(args[1], now)
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if name == b"DEL":
+            return b":%d\r\n" % int(self.data.pop(args[1], None) is not None)
+        if name == b"DBSIZE":
+            return b":%d\r\n" % len(self.data)
+        return b"+OK\r\n"
+
+    def _get(self, key, now):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self.data[key]
+            return None
+        return entry[0]
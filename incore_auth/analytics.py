@@ -0,0 +1,120 @@
+"""Background pipeline that writes analytics datapoints in batches."""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger("app.analytics")
+
+
+def log_sink(points):
+    """Sink used when no influxdb is configured, writes the points to the debug log"""
+    for point in points:
+        logger.debug(point)
+
+
+class AnalyticsWriter:
+    """Bounded queue of datapoints that is drained by a background thread. Points are handed to the
+    sink in batches of at most batch_size, and at least every flush_interval seconds. When the queue
+    is full the point is either dropped (overload="drop") or the request waits up to block_timeout
+    seconds for room in the queue (overload="block"). If set, enrich is called for every point in
+    the background, right before it is written. With a rollup the points are aggregated and only the
+    rollups, and the sampled points, are written. If serialize is set the sink gets the batch as the
+    payload returned by serialize, instead of a list of points."""
+
+    def __init__(self, sink=log_sink, maxsize=10000, batch_size=500, flush_interval=1.0,
+                 overload="drop", block_timeout=0.1, enrich=None, rollup=None, serialize=None):
+        if overload not in ("drop", "block"):
+            raise ValueError(f"Unknown overload policy {overload}")
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overload = overload
+        self.block_timeout = block_timeout
+        self.enrich = enrich
+        self.rollup = rollup
+        self.serialize = serialize
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+
+    def enqueue(self, point):
+        """Add a point to the queue, this is the only work done on the request path"""
+        try:
+            if self.overload == "block":
+                self._queue.put(point, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(point)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """Start the background flusher"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def flush(self):
+        """Write everything that is currently in the queue"""
+        while True:
+            batch = self._take(0)
+            if not batch:
+                break
+            self._write(batch)
+        if self.rollup:
+            points = self.rollup.drain()
+            if points:
+                self.sink(self.serialize(points) if self.serialize else points)
+
+    def stats(self):
+        """Return counters as well as the current queue depth"""
+        return {
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "queued": self._queue.qsize(),
+        }
+
+    def _take(self, max_wait):
+        """Collect up to batch_size points, waiting at most max_wait seconds after the first one"""
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=max_wait) if max_wait else self._queue.get_nowait())
+            deadline = time.monotonic() + max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, batch):
+        try:
+            if self.enrich:
+                for point in batch:
+                    self.enrich(point)
+            points = batch
+            if self.rollup:
+                points = self.rollup.add(batch) + self.rollup.due()
+            if points:
+                self.sink(self.serialize(points) if self.serialize else points)
+            self.flushed += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception(f"Could not write {len(batch)} analytics points")
+
+    def _run(self):
+        while True:
+            batch = self._take(self.flush_interval)
+            # rollups are written when their interval is over, also without new points
+            if batch or self.rollup:
+                self._write(batch)
@@ -1,47 +1,151 @@
 import logging
 import json
+import math
 import os
-import time
+import signal
 import threading
-import urllib.request
-
-import IP2Location
-import geohash2
-import influxdb_client
-import pymongo
-
-from cachetools import cached, TTLCache
+import time
 
 from flask import Flask, request, Response, make_response, json
+from prometheus_client import CONTENT_TYPE_LATEST
 from jose import jwt
 from jose.exceptions import JWTError, ExpiredSignatureError, JWTClaimsError
 from urllib.parse import unquote_plus
 from dotenv import load_dotenv
 
-import bson
+from analytics import AnalyticsWriter
+from clientip import PRIVATE_NETWORKS, ClientIPResolver
+from datawolf import CircuitOpenError, DataWolfClient, DataWolfError
+from keystore import KeyStore
+from lineprotocol import AuthEncoder
+from metrics import (DATAWOLF_CALLS, PHASES, RESPONSES, latest, observe_provisioning, start_refresh, watch_cache,
+                     watch_circuit, watch_queue)
+from policy import compile_policy
+from provisioning import Provisioner
+from ratelimit import RateLimiter
+from reloader import ConfigReloader
+from rollup import Rollup
+from session import SessionSigner
+from sharedstate import create_state
+from spool import Spool, SpoolingSink
+from throttle import Throttle
+from tokencache import ClaimsCache, RejectionCache, token_digest
 
 # Load .env file
 load_dotenv()
 CONTRIBUTION_DB_NAME = os.getenv('INFLUXDB_V2_FILE_LOCATION', 'data/IP2LOCATION-LITE-DB5.BIN')
 
-config = json.load(open("config.json"))
+config_file = "config.json"
+config = json.load(open(config_file))
 app = Flask(__name__)
 app.config.from_mapping(config)
-
-geoserver = {}
-geoserver_delta = 2
+policy = compile_policy(config)
 
 cache_size = 1024
 # timeout in seconds, in this case 30 minutes
 cache_timeout = 30*60
 
-# setup database for geolocation
-try:
-    geolocation = IP2Location.IP2Location(CONTRIBUTION_DB_NAME)
-except:
-    app.logger.exception("No IP2Location database found.")
-    geolocation = None
-    pass
+# state that is shared by all workers if SHARED_STATE_URL points to redis, otherwise per worker
+shared_state_url = os.getenv('SHARED_STATE_URL', '')
+shared_state = create_state(shared_state_url)
+
+# limits which requests are tracked, e.g. geoserver only once every 2 seconds per user
+throttle = Throttle(state=shared_state)
+
+# limits the request rate per user (or client address) for some resources, this is kept per worker
+limiter = RateLimiter(maxsize=int(os.getenv('RATE_LIMIT_BUCKETS', '10000')))
+
+
+def apply_config(new_config):
+    """Compile the policy of a changed config.json, including the tracking rules and rate limits, and
+    swap it in. Nothing is changed if it does not compile, requests that already started finish with
+    the policy they started with."""
+    global policy
+    policy = compile_policy(new_config)
+
+
+# config.json is checked for changes every CONFIG_CHECK_INTERVAL seconds (0 only reloads on SIGHUP)
+reloader = ConfigReloader(config_file, apply_config, check_interval=float(os.getenv('CONFIG_CHECK_INTERVAL', '5')))
+
+# timeout in seconds for calls to datawolf and mongo when provisioning a user
+provision_timeout = int(os.getenv('PROVISION_TIMEOUT', '10'))
+
+# verified claims, each entry is evicted when the token expires
+token_cache = ClaimsCache(maxsize=cache_size, shared=shared_state if shared_state_url else None)
+
+# tokens that failed verification, kept for a short time in seconds
+rejected_tokens = RejectionCache(maxsize=cache_size, ttl=int(os.getenv('REJECTED_TOKEN_TTL', '60')))
+
+
+# with a SESSION_SECRET a verified token gets a signed session cookie, later requests with the same token
+# and cookie are verified using the cookie instead of the RSA signature of the token
+session_secret = os.getenv('SESSION_SECRET', '')
+sessions = SessionSigner(
+    session_secret,
+    cookie_name=os.getenv('SESSION_COOKIE_NAME', 'incore_session'),
+    secure=os.getenv('SESSION_COOKIE_SECURE', 'true').lower() == 'true'
+) if session_secret else None
+
+
+def keys_rotated(fingerprint):
+    """Any change in keys invalidates the verified and rejected tokens, as well as the sessions"""
+    token_cache.clear(fingerprint)
+    rejected_tokens.clear()
+    if sessions:
+        sessions.rotate(fingerprint)
+
+
+# public keys used to verify tokens
+keystore = KeyStore(on_rotate=keys_rotated)
+watch_cache("token", token_cache)
+watch_cache("rejected_token", rejected_tokens)
+
+# the client address is the right most address in X-Forwarded-For that is not one of the TRUSTED_PROXIES
+trusted_proxies = os.getenv('TRUSTED_PROXIES', ','.join(PRIVATE_NETWORKS))
+client_ip = ClientIPResolver([cidr for cidr in trusted_proxies.split(',') if cidr.strip()], maxsize=4 * cache_size)
+watch_cache("client_ip", client_ip)
+
+# json separators for the X-Auth headers, compact leaves out all whitespace
+if os.getenv('AUTH_HEADER_ENCODING', 'json') == 'compact':
+    header_separators = (',', ':')
+else:
+    header_separators = (', ', ': ')
+
+# datapoints are written to influxdb in batches by a background thread
+analytics = AnalyticsWriter(
+    maxsize=int(os.getenv('ANALYTICS_QUEUE_SIZE', '10000')),
+    batch_size=int(os.getenv('ANALYTICS_BATCH_SIZE', '500')),
+    flush_interval=float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '1')),
+    overload=os.getenv('ANALYTICS_OVERLOAD', 'drop')
+)
+watch_queue("analytics", analytics)
+
+# in rollup mode only aggregates per server, resource, group, country and method are written, as well as
+# a sampled fraction of the datapoints
+if os.getenv('ANALYTICS_MODE', 'raw') == 'rollup':
+    analytics.rollup = Rollup(
+        interval=float(os.getenv('ANALYTICS_ROLLUP_INTERVAL', '60')),
+        sample=float(os.getenv('ANALYTICS_RAW_SAMPLE', '0'))
+    )
+
+
+def geolocate(point):
+    with PHASES.labels("geolocation").time():
+        geolocation.enrich(point)
+
+
+# setup database for geolocation, the file is memory mapped so the pages are shared by all workers
+geolocation = None
+if os.path.exists(CONTRIBUTION_DB_NAME):
+    try:
+        from geolocation import GeoLocator
+        geolocation = GeoLocator(CONTRIBUTION_DB_NAME)
+        analytics.enrich = geolocate
+        watch_cache("geolocation", geolocation)
+    except:
+        app.logger.exception("Could not load IP2Location database.")
+else:
+    app.logger.error("No IP2Location database found.")
 
 # setup logger to work nicely with gunicorn
 if __name__ != '__main__':
@@ -50,134 +154,186 @@ if __name__ != '__main__':
     app.logger.setLevel(gunicorn_logger.level)
 
 
-def cache_key(request_info):
-    """Return username from request_info to be used as cache key"""
-    return request_info["username"]
+def datawolf_user(request_info):
+    """Make sure the user exists in datawolf"""
+    username = request_info["username"]
+    try:
+        with PHASES.labels("datawolf").time():
+            status = config["datawolf"].add_person(request_info["firstname"], request_info["lastname"], username)
+    except CircuitOpenError:
+        DATAWOLF_CALLS.labels("skipped").inc()
+        raise
+    except Exception:
+        DATAWOLF_CALLS.labels("error").inc()
+        raise
+    DATAWOLF_CALLS.labels(str(status)).inc()
+    if status == 200:
+        app.logger.info(f"Added user to datawolf {username}")
+    elif status == 204:
+        app.logger.debug(f"User already exists in datawolf {username}")
+    else:
+        app.logger.info(f"Did not add user to datawolf {username}")
+
 
+def mongo_indexes(mongo_client):
+    """Make sure the lookups done when provisioning users are indexed. The indexes are unique if
+    the existing documents allow for it, which prevents duplicates from concurrent upserts."""
+    from pymongo.errors import OperationFailure
 
-def update_services_thread(request_info):
+    spacedb = mongo_client["spacedb"]
+    for collection, key in (("UserGroups", "username"),
+                            ("UserAllocations", "username"),
+                            ("Space", "metadata.name")):
+        try:
+            spacedb[collection].create_index(key, unique=True)
+        except OperationFailure:
+            app.logger.exception(f"Could not create unique index on {collection}.{key}")
+            spacedb[collection].create_index(key)
+
+
+def mongo_users(mongo_client, batch):
+    """Upsert groups, space and usage documents for all users in the batch, using a single bulk
+    write per collection. Existing space and usage documents are never modified."""
+    import bson
+    import pymongo
+
+    spacedb = mongo_client["spacedb"]
+
+    groups = [pymongo.UpdateOne(
+        {"username": request_info["username"]},
+        {
+            "$set": {"groups": request_info["groups"]},
+            "$setOnInsert": {"className": "edu.illinois.ncsa.incore.common.models.UserGroups"}
+        },
+        upsert=True
+    ) for request_info in batch]
+    result = spacedb["UserGroups"].bulk_write(groups, ordered=False)
+    app.logger.info(f"Synced groups documents, inserted {result.upserted_count}, "
+                    f"updated {result.modified_count} of {len(batch)}")
+
+    spaces = [pymongo.UpdateOne(
+        {"metadata.name": request_info["username"]},
+        {"$setOnInsert": {
+            "className": "edu.illinois.ncsa.incore.common.models.Space",
+            "metadata.className": "edu.illinois.ncsa.incore.common.models.SpaceMetadata",
+            "privileges": {
+                "className": "edu.illinois.ncsa.incore.common.auth.Privileges",
+                "userPrivileges": {
+                    request_info["username"]: "ADMIN"
+                }
+            },
+            "members": [
+            ]
+        }},
+        upsert=True
+    ) for request_info in batch]
+    result = spacedb["Space"].bulk_write(spaces, ordered=False)
+    if result.upserted_count:
+        app.logger.info(f"Inserted {result.upserted_count} space documents")
+
+    usages = [pymongo.UpdateOne(
+        {"username": request_info["username"]},
+        {"$setOnInsert": {
+            "className": "edu.illinois.ncsa.incore.common.models.UserAllocations",
+            "usage": {
+                "className": "edu.illinois.ncsa.incore.common.models.UserUsages",
+                "datasets": int(0),
+                "hazards": int(0),
+                "hazardDatasets": int(0),
+                "dfr3": int(0),
+                "datasetSize": bson.Int64(0),
+                "hazardDatasetSize": bson.Int64(0)
+            }
+        }},
+        upsert=True
+    ) for request_info in batch]
+    result = spacedb["UserAllocations"].bulk_write(usages, ordered=False)
+    if result.upserted_count:
+        app.logger.info(f"Inserted {result.upserted_count} usage documents")
+
+
+def provision_users(batch):
     """When a user does any action, it will check to update the groups in mongo, as well as make sure
-    the user has access to datawolf. The function is cached to make sure only every 30 minutes we do
-    the checks, since this can be expensive."""
+    the user has access to datawolf. This runs on the provisioner workers for a batch of users,
+    update_services makes sure only every 30 minutes we do the checks, since this can be expensive.
+    Everything done here is idempotent, so a failed batch can be retried."""
+    batch = [request_info for request_info in batch if request_info["username"]]
+    if not batch:
+        return
 
-    # get information from request
-    username = request_info["username"]
-    if not username:
-        return username
-    groups = request_info['groups']
-
-    # call datawolf to add user
-    datawolf_url = config["datawolf_url"]
-    if datawolf_url:
-        query = urllib.parse.urlencode({
-            "firstname": request_info["firstname"],
-            "lastname": request_info["lastname"],
-            "email": username
-        })
-        datawolf_url = "%s/persons?%s" % (datawolf_url.rstrip("/"), query)
-        req = urllib.request.Request(datawolf_url, method='POST')
-        response = urllib.request.urlopen(req)
-        if response.code == 200:
-            app.logger.info(f"Added user to datawolf {username}")
-        elif response.code == 204:
-            app.logger.debug(f"User already exists in datawolf {username}")
-        else:
-            app.logger.info(f"Did not add user to datawolf {username}")
+    # call datawolf to add user, users for which this fails or is skipped are provisioned again once
+    # datawolf may be back, this does not hold up the other users in the batch. A 4xx answer will not
+    # change by trying again, those users are synced again after cache_timeout as usual
+    retry = []
+    datawolf = config["datawolf"]
+    if datawolf:
+        for request_info in batch:
+            username = request_info["username"]
+            try:
+                datawolf_user(request_info)
+            except CircuitOpenError:
+                retry.append(username)
+            except DataWolfError as e:
+                app.logger.warning(f"Could not add user to datawolf {username}: {e}")
+                if e.status >= 500:
+                    retry.append(username)
+            except Exception:
+                app.logger.exception(f"Could not add user to datawolf {username}")
+                retry.append(username)
 
     # update database with user quota
-    mongo_client = config["mongo_client"]
-    if mongo_client:
-        mongo_user = mongo_client["spacedb"]["UserGroups"].find_one({"username": username})
-        if not mongo_user:
-            # INSERT
-            mongo_client["spacedb"]["UserGroups"].insert_one({
-                "username": username,
-                "className": "edu.illinois.ncsa.incore.common.models.UserGroups",
-                "groups": groups
-            })
-            app.logger.info(f"Inserted groups document for {username}")
-        elif set(groups) != set(mongo_user["groups"]):
-            # UPDATE
-            mongo_client["spacedb"]["UserGroups"].update_one(
-                {"username": username}, {"$set": {"groups": groups}}
-            )
-            app.logger.info(f"Synced groups for {username} - {groups}")
-        else:
-            # NOTHING
-            app.logger.debug(f"No sync needed for {username}")
-
-        mongo_space = mongo_client["spacedb"]["Space"].find_one({"metadata.name": username})
-        if not mongo_space:
-            mongo_client["spacedb"]["Space"].insert_one({
-                "className": "edu.illinois.ncsa.incore.common.models.Space",
-                "metadata": {
-                    "className": "edu.illinois.ncsa.incore.common.models.SpaceMetadata",
-                    "name": username
-                },
-                "privileges": {
-                    "className": "edu.illinois.ncsa.incore.common.auth.Privileges",
-                    "userPrivileges": {
-                        username: "ADMIN"
-                    }
-                },
-                "members": [
-                ]
-            })
-            app.logger.info(f"Inserted space document for {username}")
-
-        mongo_usage = mongo_client["spacedb"]["UserAllocations"].find_one({"username": username})
-        if not mongo_usage:
-            mongo_client["spacedb"]["UserAllocations"].insert_one({
-                "className": "edu.illinois.ncsa.incore.common.models.UserAllocations",
-                "username": username,
-                "usage": {
-                    "className": "edu.illinois.ncsa.incore.common.models.UserUsages",
-                    "datasets": int(0),
-                    "hazards": int(0),
-                    "hazardDatasets": int(0),
-                    "dfr3": int(0),
-                    "datasetSize": bson.Int64(0),
-                    "hazardDatasetSize": bson.Int64(0)
-                }
-            })
-            app.logger.info(f"Inserted space document for {username}")
+    try:
+        mongo_client = config["mongo_client"]
+        if mongo_client:
+            mongo_users(mongo_client, batch)
+    finally:
+        for username in retry:
+            shared_state.set(f"provision:{username}", 1, datawolf.reset_timeout)
+
+
+provisioner = Provisioner(
+    provision_users,
+    workers=int(os.getenv('PROVISION_WORKERS', '4')),
+    maxsize=int(os.getenv('PROVISION_QUEUE_SIZE', '1000')),
+    batch_size=int(os.getenv('PROVISION_BATCH_SIZE', '50')),
+    observe=observe_provisioning
+)
+watch_queue("provisioning", provisioner)
 
 
-@cached(cache=TTLCache(maxsize=cache_size, ttl=cache_timeout), key=cache_key)
 def update_services(request_info):
-    threading.Thread(target=update_services_thread, args=(request_info,), daemon=True).start()
+    """Provision the user at most once every cache_timeout seconds, across all workers"""
+    if shared_state.add(f"provision:{request_info['username']}", 1, cache_timeout):
+        provisioner.submit(request_info)
 
 
-def record_request(request_info):
+def should_record(request_info, policy):
+    """Return True if the request might be tracked, this is checked before the token is decoded"""
     if 'X-Forwarded-For' not in request.headers:
-        return
+        return False
 
-    # get some handy variables
-    username = request_info["username"]
+    # skip non tracked resources
     resource = request_info['resource']
-    uri = request_info['uri']
+    if resource not in policy.tracked:
+        app.logger.debug("ignoring resource %s - %s", resource, request_info)
+        return False
 
-    # only track frontpage once
-    if resource == "frontpage" and not (uri.endswith(".html") or uri.endswith("/")):
-        return
+    # only track some requests, e.g. only the html page of the frontpage
+    return throttle.wanted(policy.tracking.get(resource), request_info['uri'])
 
-    # only track manual once
-    if resource == "doc" and not (uri.endswith(".html") or uri.endswith("/")):
-        return
 
-    # only track geoserver once every second
-    if resource == "geoserver":
-        if username in geoserver and geoserver[username] > time.time():
-            return
-        geoserver[username] = time.time() + geoserver_delta
+def record_request(request_info, policy):
+    # get some handy variables
+    username = request_info["username"]
+    resource = request_info['resource']
+    uri = request_info['uri']
 
-    # skip non tracked resources
-    if resource not in config["TRACKED_RESOURCES"]:
-        app.logger.debug(f"ignoring resource {resource} - {request_info}")
+    # only track a user once per interval, e.g. geoserver tiles
+    if not throttle.allow(resource, policy.tracking.get(resource), username):
         return
-    app.logger.debug(f"adding resource {resource} - {request_info}")
+    app.logger.debug("adding resource %s - %s", resource, request_info)
 
-    remote_ip = request.headers.get('X-Forwarded-For', '')
+    remote_ip = client_ip.resolve(request.headers.get('X-Forwarded-For', ''))
     if not remote_ip:
         remote_ip = request.remote_addr
 
@@ -211,20 +367,6 @@ def record_request(request_info):
     fields.update(request_info['fields'])
     fields.update(request_info['tags'])
 
-    # calculate geo location
-    if geolocation:
-        try:
-            rec = geolocation.get_all(remote_ip)
-            tags["country_code"] = rec.country_short
-            tags["country"] = rec.country_long
-            tags["region"] = rec.region
-            tags["city"] = rec.city
-            fields["latitude"] = rec.latitude
-            fields["longitude"] = rec.longitude
-            fields["geohash"] = geohash2.encode(rec.latitude, rec.longitude)
-        except Exception:
-            app.logger.error("Could not lookup IP address")
-
     # create the datapoint that is written to influxdb
     datapoint = {
         "measurement": "auth",
@@ -233,11 +375,9 @@ def record_request(request_info):
         "time": int(time.time() * 10 ** 9)
     }
 
-    # either write to influxdb, or to console
-    if config['influxdb']:
-        config['influxdb'].write("incore", "incore", datapoint)
-    else:
-        app.logger.info(datapoint)
+    # queue for writing to influxdb, or to console
+    with PHASES.labels("analytics_enqueue").time():
+        analytics.enqueue(datapoint)
 
 
 def request_userinfo(request_info):
@@ -261,25 +401,56 @@ def request_userinfo(request_info):
         request_info['error'] = 'Missing Authorization information'
         return
 
+    # look for the token, cheapest first: verified by this worker, rejected before, the session cookie,
+    # and only then verified by another worker, which is a round trip to the shared state
+    digest = token_digest(access_token)
+    request_info['digest'] = digest
+    claims = token_cache.get(digest)
+    if claims is None:
+        error = rejected_tokens.get(digest)
+        if error:
+            app.logger.debug("token was rejected before")
+            request_info['error'] = error
+            return
+        if sessions:
+            claims = sessions.verify(request.cookies.get(sessions.cookie_name), digest)
+            if claims is not None:
+                token_cache.put(digest, claims)
+        if claims is None:
+            claims = token_cache.get_shared(digest)
+
     # decode token for validating its signature
-    try:
-        access_token = jwt.decode(access_token, config['public_key'], audience=config['audience'])
-    except ExpiredSignatureError:
-        app.logger.debug("token signature has expired")
-        request_info['error'] = 'JWT Expired Signature Error: token signature has expired'
-        return
-    except JWTClaimsError:
-        app.logger.debug("toke signature has invalid claim")
-        request_info['error'] = 'JWT Claims Error: token signature is invalid'
-        return
-    except JWTError:
-        app.logger.debug("jwt error")
-        request_info['error'] = 'JWT Error: token signature is invalid'
-        return
-    except Exception:
-        app.logger.debug("random exception")
-        request_info['error'] = 'JWT Error: invalid token'
-        return
+    if claims is None:
+        try:
+            # reject expired tokens before doing any signature work
+            exp = jwt.get_unverified_claims(access_token).get("exp")
+            if isinstance(exp, (int, float)) and exp <= time.time():
+                raise ExpiredSignatureError("Signature has expired.")
+            key = keystore.key_for_token(access_token)
+            if key is None:
+                app.logger.debug("unknown signing key")
+                request_info['error'] = 'JWT Error: unknown signing key'
+                return
+            claims = jwt.decode(access_token, key, audience=config['audience'])
+        except ExpiredSignatureError:
+            app.logger.debug("token signature has expired")
+            request_info['error'] = 'JWT Expired Signature Error: token signature has expired'
+        except JWTClaimsError:
+            app.logger.debug("toke signature has invalid claim")
+            request_info['error'] = 'JWT Claims Error: token signature is invalid'
+        except JWTError:
+            app.logger.debug("jwt error")
+            request_info['error'] = 'JWT Error: token signature is invalid'
+        except Exception:
+            app.logger.debug("random exception")
+            request_info['error'] = 'JWT Error: invalid token'
+        if request_info['error']:
+            rejected_tokens.put(digest, request_info['error'])
+            return
+        token_cache.put(digest, claims)
+        if sessions and isinstance(claims.get("exp"), (int, float)):
+            request_info['session'] = (sessions.issue(digest, claims), int(claims["exp"]))
+    access_token = claims
 
     # get name of user
     request_info["firstname"] = access_token.get("given_name", "")
@@ -298,31 +469,38 @@ def request_userinfo(request_info):
         request_info['roles'] = []
 
 
-def request_resource(request_info):
-    try:
-        uri = request.headers.get('X-Forwarded-Uri', '')
-        if not uri:
-            uri = request.url
-        request_info['uri'] = uri
-        pieces = uri.split('/')
-        if len(pieces) == 2:
-            if pieces[1] in config["TRACKED_RESOURCES"]:
-                request_info['resource'] = pieces[1]
-            else:
-                request_info['resource'] = "frontpage"
-        else:
-            request_info['resource'] = pieces[1]
-            if request_info['resource'] == "doc" and len(pieces) > 2:
-                request_info['fields']['manual'] = pieces[2]
-            if request_info['resource'] == "playbook" and len(pieces) > 2:
-                request_info['fields']['playbook'] = pieces[2]
-            if request_info['resource'] == "data" and len(pieces) > 4 and uri.endswith('blob'):
-                request_info['fields']['dataset'] = pieces[4]
-            if request_info['resource'] == "dfr3" and len(pieces) > 4:
-                request_info['fields']['fragility'] = pieces[4]
-    except IndexError:
-        app.logger.info("No / found in path.")
-        request_info['resource'] = 'NA'
+def request_resource(request_info, policy):
+    uri = request.headers.get('X-Forwarded-Uri', '')
+    if not uri:
+        uri = request.url
+    request_info['uri'] = uri
+    request_info['resource'] = policy.router.classify(uri, request_info['fields'])
+
+
+def auth_headers(request_info):
+    """Return the X-Auth headers with the user information passed on to the services"""
+    user_info = {"preferred_username": request_info['username']}
+    group_info = {"groups": request_info['groups']}
+    user_object = {
+        "username": request_info['username'],
+        "email": request_info['email'],
+        "fullname": request_info['fullname'],
+        "groups": request_info['groups'],
+        "roles": request_info['roles'],
+    }
+    return [
+        ('X-Auth-UserInfo', json.dumps(user_info, separators=header_separators)),
+        ('X-Auth-UserGroup', json.dumps(group_info, separators=header_separators)),
+        ('X-Auth-User', json.dumps(user_object, separators=header_separators)),
+    ]
+
+
+@app.before_request
+def ensure_worker():
+    """Start the worker if the post_worker_init hook did not, e.g. gunicorn with another config file"""
+    if worker_pid != os.getpid():
+        app.logger.warning("Worker was not started by post_worker_init, starting it now")
+        start_worker()
 
 
 @app.before_request
@@ -342,10 +520,9 @@ def verify_token():
     present and valid but the user does not belong to the appropriate
     groups for the protected path.
     """
-    # check if the url is for the /healthz route, in the future we might
-    # need to check what is the actual rule
+    # requests for our own routes (/healthz, /metrics) are handled by the route
     if request.url_rule is not None:
-        return healthz()
+        return None
 
     # allow options, probably CORS
     if request.headers.get('X-Forwarded-Method', '') == 'OPTIONS':
@@ -364,23 +541,54 @@ def verify_token():
         "groups": [],
         "roles": [],
         "error": "",
+        "digest": None,
+        "session": None,
         "fields": {},
         "tags": {},
         "start": time.time()
     }
 
-    # get info requested
-    request_resource(request_info)
-    request_userinfo(request_info)
+    # the policy can be reloaded at any time, this request uses the one that is current now
+    current_policy = policy
+
+    # find the resource requested, and decide what needs to be done
+    with PHASES.labels("resource").time():
+        request_resource(request_info, current_policy)
+    protected = request_info['resource'] in current_policy.protected
+    record = should_record(request_info, current_policy)
+    limit = current_policy.limits.get(request_info['resource'])
+    limited = limit is not None
+
+    # neither protected, tracked nor limited, no need to look at the token
+    if not protected and not record and not limited:
+        return Response(status=200)
+
+    # get info about the user
+    with PHASES.labels("userinfo").time():
+        request_userinfo(request_info)
+
+    # limit the rate per user, or per client address for anonymous requests
+    if limited:
+        if request_info['username']:
+            key = f"user:{request_info['username']}"
+        else:
+            key = f"ip:{client_ip.resolve(request.headers.get('X-Forwarded-For', '')) or request.remote_addr}"
+        wait = limiter.check(request_info['resource'], limit, key)
+        if wait:
+            response = make_response("too many requests", 429)
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response
 
     # update backend services
-    update_services(request_info)
+    if request_info['username']:
+        update_services(request_info)
 
     # record request
-    record_request(request_info)
+    if record:
+        record_request(request_info, current_policy)
 
     # non protected resource is always ok
-    if request_info['resource'] not in app.config["PROTECTED_RESOURCES"]:
+    if not protected:
         return Response(status=200)
 
     # check the authentication
@@ -388,36 +596,25 @@ def verify_token():
         return make_response(request_info['error'], 401)
 
     # check the authorization
-    authorized = False
-    if "GROUPS" in app.config and not authorized:
-        for group in request_info['groups']:
-            if group in app.config["GROUPS"] and request_info['resource'] in app.config["GROUPS"][group]:
-                authorized = True
-                break
-    if "ROLES" in app.config and not authorized:
-        for role in request_info['roles']:
-            if role in app.config["ROLES"] and request_info['resource'] in app.config["ROLES"][role]:
-                authorized = True
-                break
+    with PHASES.labels("authorization").time():
+        authorized = current_policy.authorized(request_info['resource'], request_info['groups'],
+                                               request_info['roles'])
     if not authorized:
         app.logger.debug("role not found in user_accessible_resources")
         return make_response("access denied", 403)
 
-    # everything is ok
-    user_info = {"preferred_username": request_info['username']}
-    group_info = {"groups": request_info['groups']}
-    user_object = {
-        "username": request_info['username'],
-        "email": request_info['email'],
-        "fullname": request_info['fullname'],
-        "groups": request_info['groups'],
-        "roles": request_info['roles'],
-    }
+    # everything is ok, the headers are the same for every request with this token
+    headers = token_cache.headers(request_info['digest'])
+    if headers is None:
+        headers = auth_headers(request_info)
+        token_cache.set_headers(request_info['digest'], headers)
 
     response = Response(status=200)
-    response.headers['X-Auth-UserInfo'] = json.dumps(user_info)
-    response.headers['X-Auth-UserGroup'] = json.dumps(group_info)
-    response.headers['X-Auth-User'] = json.dumps(user_object)
+    response.headers.extend(headers)
+    if request_info['session']:
+        value, expires = request_info['session']
+        response.set_cookie(sessions.cookie_name, value, max_age=expires - int(time.time()),
+                            secure=sessions.secure, httponly=True, samesite='Lax')
 
     if request.headers.get('Authorization') is not None:
         response.headers['Authorization'] = unquote_plus(request.headers['Authorization'])
@@ -427,39 +624,41 @@ def verify_token():
     return response
 
 
+@app.after_request
+def count_response(response):
+    if request.url_rule is None:
+        RESPONSES.labels(str(response.status_code)).inc()
+    return response
+
+
 @app.route("/healthz", methods=["GET"])
 def healthz():
     return Response("OK", 200)
 
 
-def urljson(url):
-    response = urllib.request.urlopen(url)
-    if response.code >= 200 or response <= 299:
-        encoding = response.info().get_content_charset('utf-8')
-        return json.loads(response.read().decode(encoding))
-    else:
-        raise(Exception(f"Could not load data from {url} code={response.code}"))
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(latest(), 200, content_type=CONTENT_TYPE_LATEST)
 
 
-@app.before_first_request
-def setup():
+def startup():
+    """Load everything that is read-only and shared by all workers. This runs when the module is
+    loaded, with preload_app in gunicorn.config.py that is once in the master before the workers are
+    forked, so no request has to wait for it."""
     keycloak_pem = os.environ.get('KEYCLOAK_PUBLIC_KEY', None)
     if keycloak_pem:
-        config['pem'] = str(keycloak_pem)
+        keystore.set_pem(str(keycloak_pem))
         app.logger.info("Got public_key from environment variable.")
     else:
-        keycloak_url = os.environ.get('KEYCLOAK_URL', None)
-        if keycloak_url:
-            result = urljson(keycloak_url)
-            config['pem'] = result['public_key']
-            app.logger.info("Got public_key from url.")
+        jwks_url = os.environ.get('KEYCLOAK_JWKS_URL', None)
+        if not jwks_url and os.environ.get('KEYCLOAK_URL', None):
+            jwks_url = f"{os.environ['KEYCLOAK_URL'].rstrip('/')}/protocol/openid-connect/certs"
+        if jwks_url:
+            keystore.jwks_url = jwks_url
+            keystore.refresh()
+            app.logger.info(f"Loaded public keys from {jwks_url}.")
         else:
-            config['pem'] = ''
-            app.logger.error("Could not find PEM, things will be broken.")
-
-    config['public_key'] = f"-----BEGIN PUBLIC KEY-----\n" \
-                           f"{config['pem']}\n" \
-                           f"-----END PUBLIC KEY-----"
+            app.logger.error("Could not find PEM or JWKS url, things will be broken.")
 
     keycloak_audience = os.environ.get('KEYCLOAK_AUDIENCE', None)
     if keycloak_audience:
@@ -469,24 +668,97 @@ def setup():
 
     # store datawolf url
     config["datawolf_url"] = os.environ.get('DATAWOLF_URL', None)
+    config["datawolf"] = None
+    config["mongo_client"] = None
+    config['influxdb'] = None
+
+
+# pid of the process that created the clients and started the background threads
+worker_pid = None
+worker_lock = threading.Lock()
+
+
+def start_worker():
+    """Create the network clients and start the background threads. Neither survives a fork, so
+    this runs in every worker from the post_worker_init hook in gunicorn.config.py, or right after
+    startup() when not running in gunicorn. If neither happened it runs on the first request of the
+    worker. The client libraries are only imported if configured."""
+    global worker_pid
+    with worker_lock:
+        if worker_pid == os.getpid():
+            return
+        worker_pid = os.getpid()
+
+    # setup datawolf, with a connection per provisioning worker
+    if config["datawolf_url"]:
+        datawolf = DataWolfClient(
+            config["datawolf_url"],
+            pool_size=provisioner.workers,
+            connect_timeout=float(os.getenv('DATAWOLF_CONNECT_TIMEOUT', '2')),
+            read_timeout=provision_timeout,
+            failure_threshold=int(os.getenv('DATAWOLF_FAILURE_THRESHOLD', '5')),
+            reset_timeout=float(os.getenv('DATAWOLF_RESET_TIMEOUT', '30'))
+        )
+        config["datawolf"] = datawolf
+        watch_circuit("datawolf", datawolf)
 
     # setup mongodb
     mongodb_uri = os.environ.get('MONGODB_URI', None)
     if mongodb_uri:
-        mongo_client = pymongo.MongoClient(mongodb_uri)
+        import pymongo
+        mongo_client = pymongo.MongoClient(mongodb_uri,
+                                           connectTimeoutMS=provision_timeout * 1000,
+                                           socketTimeoutMS=provision_timeout * 1000,
+                                           serverSelectionTimeoutMS=provision_timeout * 1000)
         config["mongo_client"] = mongo_client
+        try:
+            mongo_indexes(mongo_client)
+        except Exception:
+            app.logger.exception("Could not create mongo indexes")
+
+    # setup influxdb, without it datapoints are logged
+    if os.environ.get('INFLUXDB_V2_URL', None):
+        try:
+            import influxdb_client
+            from influxdb_client.client.write_api import SYNCHRONOUS
+            client = influxdb_client.InfluxDBClient.from_env_properties()
+            writer = client.write_api(write_options=SYNCHRONOUS)
+            config['influxdb'] = writer
+            sink = lambda points: writer.write("incore", "incore", points)
+
+            # keep the datapoints on disk while influxdb is unavailable
+            spool_dir = os.getenv('ANALYTICS_SPOOL_DIR', '')
+            if spool_dir:
+                sink = SpoolingSink(
+                    sink,
+                    Spool(spool_dir,
+                          segment_size=int(os.getenv('ANALYTICS_SPOOL_SEGMENT_MB', '8')) * 1024 * 1024,
+                          max_bytes=int(os.getenv('ANALYTICS_SPOOL_MAX_MB', '512')) * 1024 * 1024),
+                    rate=int(os.getenv('ANALYTICS_REPLAY_RATE', '5000'))
+                )
+                sink.start()
+            analytics.sink = sink
+            analytics.serialize = AuthEncoder().encode
+        except:
+            app.logger.exception("Could not setup influxdb writer")
     else:
-        config["mongo_client"] = None
+        app.logger.warning("No influxdb configured, datapoints are logged at debug level.")
 
-    # setup influxdb
-    try:
-        client = influxdb_client.InfluxDBClient.from_env_properties()
-        writer = client.write_api()
-        config['influxdb'] = writer
-    except:
-        app.logger.exception("Could not setup influxdb writer")
-        config['influxdb'] = None
-        pass
+    analytics.start()
+    provisioner.start()
+    keystore.start()
+    start_refresh()
+
+    # reload config.json when it changes, or right away on SIGHUP
+    reloader.start()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, reloader.trigger)
+
+
+startup()
+# gunicorn starts every worker using start_worker, see gunicorn.config.py, or else ensure_worker does
+if "gunicorn" not in os.environ.get("SERVER_SOFTWARE", ""):
+    start_worker()
 
 
 # for testing locally
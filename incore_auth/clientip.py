@@ -0,0 +1,106 @@
+"""Find the address of the client in the X-Forwarded-For chain."""
+import ipaddress
+import threading
+
+from cachetools import LRUCache
+
+# proxies in front of incore-auth are on private networks unless configured otherwise
+PRIVATE_NETWORKS = ("127.0.0.0/8", "10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "::1/128", "fc00::/7")
+
+
+class CidrTrie:
+    """Binary trie over the bits of the network addresses, one for IPv4 and one for IPv6. A node is a
+    tuple (zero, one, terminal), a lookup follows the bits of the address until it reaches a
+    terminal node, so it takes at most as many steps as the longest prefix."""
+
+    def __init__(self, cidrs):
+        roots = {4: [None, None, False], 6: [None, None, False]}
+        for cidr in cidrs:
+            network = ipaddress.ip_network(cidr.strip(), strict=False)
+            node = roots[network.version]
+            value = int(network.network_address)
+            for i in range(network.prefixlen):
+                if node[2]:
+                    break
+                bit = (value >> (network.max_prefixlen - 1 - i)) & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, False]
+                node = node[bit]
+            else:
+                # everything below a terminal node is covered by it
+                node[:] = [None, None, True]
+        self.roots = {version: self._freeze(root) for version, root in roots.items()}
+
+    def __contains__(self, address):
+        node = self.roots[address.version]
+        value = int(address)
+        shift = address.max_prefixlen - 1
+        while node is not None:
+            if node[2]:
+                return True
+            node = node[(value >> shift) & 1]
+            shift -= 1
+        return False
+
+    def _freeze(self, node):
+        if node is None:
+            return None
+        return self._freeze(node[0]), self._freeze(node[1]), node[2]
+
+
+def parse_address(hop):
+    """Return the address of a hop in the chain, which can have a port, or None if it is not valid"""
+    hop = hop.strip()
+    if hop.startswith("["):
+        hop = hop[1:hop.find("]")]
+    elif hop.count(":") == 1:
+        hop = hop.split(":")[0]
+    try:
+        address = ipaddress.ip_address(hop)
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+
+class ClientIPResolver:
+    """Walks the X-Forwarded-For chain from right to left, skipping the proxies in the trusted
+    networks, the first address that is not trusted is the client. If all hops are trusted the left
+    most one is used. The result is cached per header value."""
+
+    def __init__(self, trusted=PRIVATE_NETWORKS, maxsize=4096):
+        self.trusted = CidrTrie(trusted)
+        self.hits = 0
+        self.misses = 0
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def resolve(self, forwarded_for):
+        """Return the client address for the value of the X-Forwarded-For header, or '' if none of
+        the hops is a valid address"""
+        with self._lock:
+            client = self._cache.get(forwarded_for)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+
+        client = ""
+        for hop in reversed(forwarded_for.split(",")):
+            address = parse_address(hop)
+            if address is None:
+                # anything left of a hop we can't read can not be trusted either
+                break
+            client = str(address)
+            if address not in self.trusted:
+                break
+
+        with self._lock:
+            self._cache[forwarded_for] = client
+        return client
+
+    def stats(self):
+        """Return hit and miss counters as well as the current size"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
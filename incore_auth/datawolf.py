@@ -0,0 +1,154 @@
+"""Client for the DataWolf calls done when provisioning users."""
+import http.client
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger("app.datawolf")
+
+
+class DataWolfError(Exception):
+    """DataWolf answered with an error status"""
+
+    def __init__(self, status):
+        super().__init__(f"DataWolf returned status {status}")
+        self.status = status
+
+
+class CircuitOpenError(Exception):
+    """DataWolf is skipped since it failed too often, it will be tried again later"""
+
+
+class DataWolfClient:
+    """Keeps up to pool_size persistent connections to DataWolf, so a user is added without a new TCP
+    (and TLS) connection. Connecting is bounded by connect_timeout and every response by read_timeout.
+    After failure_threshold consecutive failures the circuit opens and calls fail right away with
+    CircuitOpenError, after reset_timeout seconds a single call is let through to see if DataWolf is
+    back."""
+
+    def __init__(self, url, pool_size=4, connect_timeout=2, read_timeout=10, failure_threshold=5,
+                 reset_timeout=30):
+        parsed = urllib.parse.urlsplit(url)
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.requests = 0
+        self.failures = 0
+        self.skipped = 0
+        self.connections = 0
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+        self._consecutive = 0
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def add_person(self, firstname, lastname, email):
+        """Make sure the person exists, returns 200 if it was added and 204 if it already existed"""
+        query = urllib.parse.urlencode({"firstname": firstname, "lastname": lastname, "email": email})
+        return self.request("POST", f"/persons?{query}")
+
+    def request(self, method, path):
+        """Send a request without body and return the status, raises DataWolfError on error status"""
+        self._allow()
+        try:
+            status = self._send(method, self.path + path)
+        except Exception:
+            self._failed()
+            raise
+        if status >= 500:
+            self._failed()
+            raise DataWolfError(status)
+        self._succeeded()
+        if status >= 400:
+            raise DataWolfError(status)
+        return status
+
+    def stats(self):
+        """Return counters, the number of idle connections and if the circuit is open"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "skipped": self.skipped,
+                "connections": self.connections,
+                "idle": self._idle.qsize(),
+                "open": self._opened is not None,
+            }
+
+    def _connection(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            self.connections += 1
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+
+    def _send(self, method, url):
+        # a pooled connection may have been closed by the server, in that case it is tried once more
+        # on a new connection
+        for attempt in range(2):
+            conn = self._connection()
+            reused = conn.sock is not None
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    conn.sock.settimeout(self.read_timeout)
+                conn.request(method, url, headers={"Content-Length": "0"})
+                response = conn.getresponse()
+                response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self._idle.put_nowait(conn)
+                except queue.Full:
+                    conn.close()
+            return response.status
+
+    def _allow(self):
+        with self._lock:
+            self.requests += 1
+            if self._opened is None:
+                return
+            if self._probing or time.monotonic() - self._opened < self.reset_timeout:
+                self.skipped += 1
+                raise CircuitOpenError("DataWolf is unavailable")
+            # half open, this call decides if the circuit closes again
+            self._probing = True
+
+    def _failed(self):
+        with self._lock:
+            self.failures += 1
+            self._consecutive += 1
+            self._probing = False
+            if self._opened is not None or self._consecutive >= self.failure_threshold:
+                if self._opened is None:
+                    logger.warning(f"DataWolf failed {self._consecutive} times, skipping it for "
+                                   f"{self.reset_timeout} seconds")
+                self._opened = time.monotonic()
+
+    def _succeeded(self):
+        with self._lock:
+            if self._opened is not None:
+                logger.info("DataWolf is available again")
+            self._consecutive = 0
+            self._opened = None
+            self._probing = False
@@ -0,0 +1,116 @@
+"""Geolocation of IP addresses, used to enrich analytics datapoints."""
+import logging
+import mmap
+import threading
+import time
+
+import IP2Location
+import geohash2
+
+from cachetools import TTLCache
+
+from reloader import file_identity
+
+logger = logging.getLogger("app.geolocation")
+
+
+class MappedIP2Location(IP2Location.IP2Location):
+    """IP2Location database that is memory mapped read-only. The pages come from the page cache and
+    are shared by all workers, instead of every worker reading the file into its own buffers."""
+
+    def __init__(self, filename):
+        super().__init__(filename, mode='FILE_IO')
+
+    def open(self, filename):
+        # the header is parsed from the file, after which all reads go to the mapping
+        self.mode = 'FILE_IO'
+        super().open(filename)
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._f.close()
+        self._f = mapped
+        self.mode = 'SHARED_MEMORY'
+
+
+class GeoLocator:
+    """Looks up IP addresses in the IP2Location database. Results, including failed lookups, are
+    kept in a bounded LRU cache with a TTL since the same addresses show up all day. Every
+    check_interval seconds the file is checked, if it was replaced the new database is swapped in."""
+
+    def __init__(self, filename, maxsize=4096, ttl=24*60*60, check_interval=60):
+        self.filename = filename
+        self.check_interval = check_interval
+        self.database = MappedIP2Location(filename)
+        self.hits = 0
+        self.misses = 0
+        self._identity = file_identity(filename)
+        self._next_check = time.monotonic() + check_interval
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def reload(self):
+        """Swap in the database file if it changed, returns True if a new database was loaded"""
+        try:
+            identity = file_identity(self.filename)
+            if identity == self._identity:
+                return False
+            database = MappedIP2Location(self.filename)
+        except Exception:
+            logger.exception(f"Could not load IP2Location database {self.filename}")
+            return False
+
+        # lookups in progress keep using the old mapping until they finish
+        with self._lock:
+            self.database = database
+            self._identity = identity
+            self._cache.clear()
+        logger.info(f"Loaded new IP2Location database {self.filename}")
+        return True
+
+    def lookup(self, ip):
+        """Return (tags, fields) for the ip address, or None if it can not be located"""
+        if time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + self.check_interval
+            self.reload()
+
+        with self._lock:
+            try:
+                result = self._cache[ip]
+                self.hits += 1
+                return result
+            except KeyError:
+                self.misses += 1
+
+        result = None
+        try:
+            rec = self.database.get_all(ip)
+            tags = {
+                "country_code": rec.country_short,
+                "country": rec.country_long,
+                "region": rec.region,
+                "city": rec.city,
+            }
+            fields = {
+                "latitude": rec.latitude,
+                "longitude": rec.longitude,
+                "geohash": geohash2.encode(rec.latitude, rec.longitude),
+            }
+            result = (tags, fields)
+        except Exception:
+            logger.error(f"Could not lookup IP address {ip}")
+
+        with self._lock:
+            self._cache[ip] = result
+        return result
+
+    def enrich(self, point):
+        """Add the location of the ip field to the datapoint"""
+        result = self.lookup(point["fields"].get("ip", ""))
+        if result:
+            point["tags"].update(result[0])
+            point["fields"].update(result[1])
+
+    def stats(self):
+        """Return hit and miss counters as well as the current size"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
@@ -1,7 +1,46 @@
 """Gunicorn configuration."""
+import glob
+import os
 
 bind = '0.0.0.0:5000'
 
 workers = 1
 worker_class = 'gevent'
 worker_connections = 100
+
+# load the app, keys, policy and geolocation database once in the master, the workers share them
+preload_app = True
+
+# the app is loaded before the workers patch the standard library, so gevent patches it here
+if worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def post_worker_init(worker):
+    """Create the clients and background threads of the app in the new worker"""
+    import app
+    app.start_worker()
+
+
+def on_reload(server):
+    """SIGHUP on the master, read config.json again so the new workers are forked with it"""
+    if preload_app:
+        import app
+        app.reloader.reload(force=True)
+
+
+def on_starting(server):
+    """Remove the metrics files of a previous run, see PROMETHEUS_MULTIPROC_DIR in the README"""
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for filename in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(filename)
+
+
+def child_exit(server, worker):
+    """Stop reporting the gauges of a worker that is gone"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
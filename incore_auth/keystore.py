@@ -0,0 +1,118 @@
+"""Signing keys used to verify tokens, indexed by kid and parsed only once."""
+import hashlib
+import json
+import logging
+import threading
+import time
+import urllib.request
+
+from jose import jwk, jwt
+
+logger = logging.getLogger("app.keystore")
+
+
+def fetch_jwks(url, timeout=10):
+    """Download the JSON Web Key Set from the given url"""
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        encoding = response.info().get_content_charset('utf-8')
+        return json.loads(response.read().decode(encoding))
+
+
+class KeyStore:
+    """Holds parsed public keys. Keys either come from a single static PEM or from a JWKS url that is
+    refreshed in the background, as well as on demand (single-flight) when a token has an unknown kid.
+    When the keys change on_rotate is called with the fingerprint of the new keys."""
+
+    def __init__(self, jwks_url=None, refresh_interval=60*60, min_refresh_interval=30, on_rotate=None):
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.on_rotate = on_rotate
+        self._keys = {}
+        self._static = None
+        self._fingerprint = ""
+        self._last_refresh = 0
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def set_pem(self, pem):
+        """Use a single static public key (base64 body of the PEM) for all tokens"""
+        public_key = f"-----BEGIN PUBLIC KEY-----\n" \
+                     f"{pem}\n" \
+                     f"-----END PUBLIC KEY-----"
+        self._static = jwk.construct(public_key, "RS256")
+        self._fingerprint = hashlib.blake2b(pem.encode("utf-8"), digest_size=8).hexdigest()
+        self._rotated()
+
+    def refresh(self):
+        """Fetch the JWKS and atomically replace the known keys, returns True if the keys changed"""
+        self._last_refresh = time.time()
+        try:
+            jwks = fetch_jwks(self.jwks_url)
+        except Exception:
+            logger.exception(f"Could not fetch keys from {self.jwks_url}")
+            return False
+
+        keys = {}
+        for key_data in jwks.get("keys", []):
+            if key_data.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[key_data.get("kid")] = jwk.construct(key_data, key_data.get("alg", "RS256"))
+            except Exception:
+                logger.exception(f"Could not parse key {key_data.get('kid')}")
+
+        if keys.keys() == self._keys.keys():
+            return False
+        self._keys = keys
+        self._fingerprint = hashlib.blake2b(",".join(sorted(str(kid) for kid in keys)).encode("utf-8"),
+                                            digest_size=8).hexdigest()
+        logger.info(f"Loaded signing keys {list(keys)}")
+        self._rotated()
+        return True
+
+    def get(self, kid):
+        """Return the parsed key for the kid, refreshing the JWKS once if the kid is unknown"""
+        if self._static:
+            return self._static
+        key = self._find(kid)
+        if key is None and self.jwks_url:
+            with self._refresh_lock:
+                # if another request just refreshed the keys, don't fetch again
+                key = self._find(kid)
+                if key is None and time.time() - self._last_refresh >= self.min_refresh_interval:
+                    self.refresh()
+                    key = self._find(kid)
+        return key
+
+    def key_for_token(self, token):
+        """Return the parsed key that signed the token"""
+        if self._static:
+            return self._static
+        return self.get(jwt.get_unverified_header(token).get("kid"))
+
+    def start(self):
+        """Start the background thread that loads and periodically refreshes the keys"""
+        if not self.jwks_url or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _find(self, kid):
+        keys = self._keys
+        if kid is None and len(keys) == 1:
+            return next(iter(keys.values()))
+        return keys.get(kid)
+
+    def _run(self):
+        while True:
+            # keys that were loaded before the worker was forked are not fetched again right away
+            delay = self._last_refresh + self.refresh_interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self._refresh_lock:
+                self.refresh()
+
+    def _rotated(self):
+        if self.on_rotate:
+            self.on_rotate(self._fingerprint)
@@ -0,0 +1,99 @@
+"""Prometheus metrics for the forward auth requests and background work."""
+import os
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# with more than one gunicorn worker every worker has its own metrics, if PROMETHEUS_MULTIPROC_DIR is set
+# they are written to files in that directory and /metrics reports the metrics of all workers together
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# forward auth is expected to be fast, most buckets are below 10ms
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+PHASES = Histogram("incore_auth_phase_seconds", "Time spent in each phase of handling a request",
+                   ["phase"], buckets=BUCKETS)
+RESPONSES = Counter("incore_auth_responses_total", "Responses by http status", ["status"])
+CACHE_HIT_RATIO = Gauge("incore_auth_cache_hit_ratio", "Fraction of lookups found in the cache", ["cache"],
+                        multiprocess_mode="liveall")
+QUEUE_DEPTH = Gauge("incore_auth_queue_depth", "Items waiting in a background queue", ["queue"],
+                    multiprocess_mode="livesum")
+DATAWOLF_CALLS = Counter("incore_auth_datawolf_calls_total", "Calls to DataWolf by http status, error or skipped",
+                         ["result"])
+# users wait in the provisioning queue and calls are retried with backoff, this takes seconds rather than ms
+PROVISIONING_SECONDS = Histogram("incore_auth_provisioning_seconds", "Time from queueing a user until provisioned",
+                                 ["result"], buckets=(.01, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+PROVISIONING = Counter("incore_auth_provisioning_total", "Users provisioned, failed, dropped or coalesced",
+                       ["result"])
+CIRCUIT_OPEN = Gauge("incore_auth_circuit_open", "1 while calls to a service are skipped", ["service"],
+                     multiprocess_mode="livemax")
+
+# gauges that are computed from the stats of a cache, queue or client, in multiprocess mode
+# these can not be computed when scraped, so every worker sets them every few seconds
+watched = []
+
+
+def hit_ratio(stats):
+    """Return the hit ratio for the stats of a cache"""
+    total = stats["hits"] + stats["misses"]
+    return stats["hits"] / total if total else 0.0
+
+
+def watch(gauge, function):
+    """Report the value returned by function as the gauge"""
+    if MULTIPROCESS:
+        watched.append((gauge, function))
+    else:
+        gauge.set_function(function)
+
+
+def watch_cache(name, cache):
+    """Report the hit ratio of a cache that has a stats() method"""
+    watch(CACHE_HIT_RATIO.labels(name), lambda: hit_ratio(cache.stats()))
+
+
+def watch_queue(name, worker):
+    """Report the queue depth of a background worker that has a stats() method"""
+    watch(QUEUE_DEPTH.labels(name), lambda: worker.stats()["queued"])
+
+
+def watch_circuit(name, client):
+    """Report if the circuit breaker of a client that has a stats() method is open"""
+    watch(CIRCUIT_OPEN.labels(name), lambda: float(client.stats()["open"]))
+
+
+def observe_provisioning(result, latency):
+    """Count a user handled by the provisioner, and how long it took if it was queued"""
+    PROVISIONING.labels(result).inc()
+    if latency is not None:
+        PROVISIONING_SECONDS.labels(result).observe(latency)
+
+
+def refresh():
+    """Set the watched gauges of this process"""
+    for gauge, function in watched:
+        gauge.set(function())
+
+
+def start_refresh(interval=5):
+    """In multiprocess mode set the watched gauges every interval seconds in the background"""
+    if not MULTIPROCESS:
+        return
+
+    def run():
+        while True:
+            refresh()
+            time.sleep(interval)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def latest():
+    """Return the metrics in the text format, of all workers in multiprocess mode"""
+    if not MULTIPROCESS:
+        return generate_latest()
+    refresh()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
@@ -0,0 +1,118 @@
+"""Access policy from config.json compiled into lookup structures."""
+from ratelimit import compile_limits
+from router import Router
+from throttle import compile_rules
+
+
+class Policy:
+    """Immutable, compiled version of PROTECTED_RESOURCES, TRACKED_RESOURCES, GROUPS and ROLES. For
+    every resource the groups and roles that are allowed to access it are kept as a frozenset, so
+    authorization is a single set intersection. The router classifies uris into these resources.
+    The tracking rules and rate limits per resource are part of the policy as well, so a reload swaps
+    all of them at once."""
+
+    __slots__ = ("protected", "tracked", "groups", "roles", "router", "tracking", "limits")
+
+    def __init__(self, protected, tracked, groups, roles, router, tracking=None, limits=None):
+        self.protected = protected
+        self.tracked = tracked
+        self.groups = groups
+        self.roles = roles
+        self.router = router
+        self.tracking = tracking or {}
+        self.limits = limits or {}
+
+    def authorized(self, resource, groups, roles):
+        """Return True if any of the groups or roles gives access to the resource"""
+        allowed = self.groups.get(resource)
+        if allowed and not allowed.isdisjoint(groups):
+            return True
+        allowed = self.roles.get(resource)
+        if allowed and not allowed.isdisjoint(roles):
+            return True
+        return False
+
+
+def invert(mapping):
+    """Turn {principal: [resource, ...]} into {resource: frozenset(principal, ...)}"""
+    index = {}
+    for principal, resources in mapping.items():
+        for resource in resources:
+            index.setdefault(resource, set()).add(principal)
+    return {resource: frozenset(principals) for resource, principals in index.items()}
+
+
+def string_list(config, section):
+    value = config.get(section, [])
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"{section} should be a list of strings")
+    return value
+
+
+def number(value):
+    """Return True if the value is an int or float, json true and false are not numbers"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate(config):
+    """Check the policy sections of config.json, raises ValueError describing the first problem"""
+    if not isinstance(config, dict):
+        raise ValueError("config should be a json object")
+    string_list(config, "PROTECTED_RESOURCES")
+    string_list(config, "TRACKED_RESOURCES")
+    for section in ("GROUPS", "ROLES"):
+        mapping = config.get(section, {})
+        if not isinstance(mapping, dict):
+            raise ValueError(f"{section} should be an object of lists")
+        for principal in mapping:
+            string_list(mapping, principal)
+
+    rules = config.get("RESOURCE_FIELDS", [])
+    if not isinstance(rules, list):
+        raise ValueError("RESOURCE_FIELDS should be a list of rules")
+    for rule in rules:
+        if not isinstance(rule, dict) or not {"resource", "field", "segment"} <= rule.keys() \
+                or not rule.keys() <= {"resource", "field", "segment", "suffix"} \
+                or not isinstance(rule["resource"], str) or not isinstance(rule["field"], str) \
+                or not isinstance(rule["segment"], int) or isinstance(rule["segment"], bool) \
+                or rule["segment"] < 0 or not isinstance(rule.get("suffix", ""), str):
+            raise ValueError(f"invalid RESOURCE_FIELDS rule {rule}")
+
+    rules = config.get("TRACKING_RULES", {})
+    if not isinstance(rules, dict):
+        raise ValueError("TRACKING_RULES should be an object of rules")
+    for resource, rule in rules.items():
+        if not isinstance(rule, dict) or not rule.keys() <= {"suffixes", "interval", "sample"}:
+            raise ValueError(f"invalid TRACKING_RULES rule for {resource}")
+        suffixes = rule.get("suffixes", [])
+        if not isinstance(suffixes, list) or not all(isinstance(suffix, str) for suffix in suffixes):
+            raise ValueError(f"TRACKING_RULES suffixes for {resource} should be a list of strings")
+        if not number(rule.get("interval", 0)) or rule.get("interval", 0) < 0:
+            raise ValueError(f"TRACKING_RULES interval for {resource} should be a number of seconds")
+        if not number(rule.get("sample", 1)) or not 0 <= rule.get("sample", 1) <= 1:
+            raise ValueError(f"TRACKING_RULES sample for {resource} should be a number between 0 and 1")
+
+    rules = config.get("RATE_LIMITS", {})
+    if not isinstance(rules, dict):
+        raise ValueError("RATE_LIMITS should be an object of rules")
+    for resource, rule in rules.items():
+        if not isinstance(rule, dict) or not rule.keys() <= {"rate", "burst"} \
+                or not number(rule.get("rate")) or rule["rate"] <= 0 \
+                or not number(rule.get("burst", rule["rate"])) or rule.get("burst", rule["rate"]) < 1:
+            raise ValueError(f"invalid RATE_LIMITS rule for {resource}")
+
+
+def compile_policy(config):
+    """Validate and compile the policy sections of config.json"""
+    validate(config)
+    protected = frozenset(config.get("PROTECTED_RESOURCES", []))
+    tracked = frozenset(config.get("TRACKED_RESOURCES", []))
+    return Policy(
+        protected=protected,
+        tracked=tracked,
+        groups=invert(config.get("GROUPS", {})),
+        roles=invert(config.get("ROLES", {})),
+        router=Router(protected | tracked, config.get("RESOURCE_FIELDS", [])),
+        tracking=compile_rules(config.get("TRACKING_RULES", {})),
+        limits=compile_limits(config.get("RATE_LIMITS", {})),
+    )
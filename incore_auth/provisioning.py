@@ -0,0 +1,120 @@
+"""Bounded pool of workers that provisions users in the backend services."""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger("app.provisioning")
+
+
+class Provisioner:
+    """Runs handler([request_info, ...]) on a fixed number of worker threads, every call gets up to
+    batch_size users that are waiting. A user that is already waiting is not queued again, when the
+    queue is full the request is dropped, it will be retried the next time the user is seen. Failed
+    calls are retried with exponential backoff, so the handler should be idempotent. If given,
+    observe(result, latency) is called for every user, with result completed, failed, dropped or
+    coalesced, and the seconds from submit until done (None if the user was not queued)."""
+
+    def __init__(self, handler, workers=4, maxsize=1000, batch_size=50, retries=3, backoff=1.0, observe=None):
+        self.handler = handler
+        self.observe = observe
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, request_info):
+        """Queue the user for provisioning, returns False if the user was not queued"""
+        username = request_info["username"]
+        with self._lock:
+            if username in self._pending:
+                self.coalesced += 1
+                result = "coalesced"
+            else:
+                try:
+                    self._queue.put_nowait((time.monotonic(), request_info))
+                    self._pending.add(username)
+                    self.submitted += 1
+                    return True
+                except queue.Full:
+                    self.dropped += 1
+                    result = "dropped"
+        if self.observe:
+            self.observe(result, None)
+        return False
+
+    def start(self):
+        """Start the worker threads"""
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stats(self):
+        """Return counters, queue depth and latency (seconds from submit until done)"""
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "pending": len(self._pending),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retried": self.retried,
+                "latency_avg": self.latency_total / self.completed if self.completed else 0.0,
+                "latency_max": self.latency_max,
+            }
+
+    def _call(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                self.handler(batch)
+                return True
+            except Exception:
+                if attempt == self.retries:
+                    usernames = [request_info["username"] for request_info in batch]
+                    logger.exception(f"Could not provision {usernames}")
+                    return False
+                self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            success = False
+            try:
+                success = self._call([request_info for _, request_info in batch])
+            finally:
+                done = time.monotonic()
+                with self._lock:
+                    for submitted, request_info in batch:
+                        self._pending.discard(request_info["username"])
+                        if success:
+                            latency = done - submitted
+                            self.completed += 1
+                            self.latency_total += latency
+                            self.latency_max = max(self.latency_max, latency)
+                        else:
+                            self.failed += 1
+                if self.observe:
+                    result = "completed" if success else "failed"
+                    for submitted, _ in batch:
+                        self.observe(result, done - submitted)
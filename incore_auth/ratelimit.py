@@ -0,0 +1,52 @@
+"""Limit the request rate per user or client address, based on per resource rules from config.json."""
+import threading
+import time
+
+from collections import OrderedDict
+
+
+def compile_limits(rules):
+    """Turn the rules, given as {resource: {rate, burst}}, into {resource: (rate, burst)}"""
+    return {resource: (float(rule["rate"]), float(rule.get("burst", rule["rate"])))
+            for resource, rule in rules.items()}
+
+
+class RateLimiter:
+    """Token bucket per resource and key (user or client address), the rate and burst of a resource
+    are part of the policy. A bucket holds at most burst tokens and gains rate tokens per second, it
+    is only refilled when it is used. At most maxsize buckets are kept, the least recently used
+    bucket is removed first (and starts full when it comes back)."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, resource, limit, key):
+        """Take a token, limit is the (rate, burst) of the resource. Returns 0 if the request is allowed,
+        otherwise the seconds until it is"""
+        if limit is None:
+            return 0
+        rate, burst = limit
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get((resource, key))
+            if bucket is None:
+                bucket = self._buckets[(resource, key)] = [burst, now]
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end((resource, key))
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self.limited += 1
+            return (1 - bucket[0]) / rate
+
+    def stats(self):
+        """Return the number of limited requests and buckets"""
+        with self._lock:
+            return {"limited": self.limited, "size": len(self._buckets)}
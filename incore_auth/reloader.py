@@ -0,0 +1,73 @@
+"""Reload config.json while running, when the file is replaced or on SIGHUP."""
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("app.reloader")
+
+
+def file_identity(filename):
+    """Return what is used to detect that the file (a path or an open file descriptor) was changed or
+    replaced, this is also used for the IP2Location database"""
+    stat = os.stat(filename)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class ConfigReloader:
+    """Checks the config file every check_interval seconds, or right away when triggered (SIGHUP). When
+    it changed the parsed config is passed to on_change, which compiles it and swaps it in. If reading
+    or compiling fails the running config is kept and the error is logged."""
+
+    def __init__(self, filename, on_change, check_interval=5):
+        self.filename = filename
+        self.on_change = on_change
+        self.check_interval = check_interval
+        self.reloads = 0
+        self.failures = 0
+        self._identity = file_identity(filename)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def reload(self, force=False):
+        """Apply the file if it changed (or always if force), returns True if a new config was applied"""
+        with self._lock:
+            identity = None
+            try:
+                if file_identity(self.filename) == self._identity and not force:
+                    return False
+                with open(self.filename) as f:
+                    # the identity of the file that is read, the path may be replaced meanwhile
+                    identity = file_identity(f.fileno())
+                    config = json.load(f)
+                self.on_change(config)
+            except Exception:
+                self.failures += 1
+                logger.exception(f"Could not reload {self.filename}, keeping the current config")
+                return False
+            finally:
+                # a broken file is only reported once, it is tried again when it changes
+                if identity is not None:
+                    self._identity = identity
+            self.reloads += 1
+            logger.info(f"Reloaded {self.filename}")
+            return True
+
+    def trigger(self, *args):
+        """Reload as soon as possible, safe to use as a signal handler"""
+        self._wakeup.set()
+
+    def start(self):
+        """Start the background thread that watches the file"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            # without an interval the file is only read again when triggered
+            forced = self._wakeup.wait(self.check_interval or None)
+            self._wakeup.clear()
+            self.reload(force=forced)
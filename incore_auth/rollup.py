@@ -0,0 +1,100 @@
+"""Aggregate analytics datapoints into per interval rollups."""
+import os
+import random
+import time
+
+# tags of the auth datapoint that make up a rollup, these have a small number of distinct values
+KEY_TAGS = ("server", "resource", "group", "country", "http_method")
+
+
+class Rollup:
+    """Counts the datapoints per combination of KEY_TAGS over interval seconds, together with the
+    number of distinct users and statistics of the elapsed field. When the interval is over a single
+    point per combination is emitted. A sample fraction of the datapoints is also kept as is. Every
+    writer adds its own offset (below a second, random per process unless given) in nanoseconds to
+    the start of the interval, influxdb keeps only the last point per series and timestamp, so
+    without it the rollups of workers would overwrite each other. Queries have to sum per interval."""
+
+    def __init__(self, interval=60, sample=0.0, measurement="auth_rollup", offset=None):
+        self.interval = interval
+        self.sample = sample
+        self.measurement = measurement
+        self.offset = offset
+        self.aggregated = 0
+        self.emitted = 0
+        self._start = self._window(time.time())
+        self._groups = {}
+        self._pid = None
+        self._random_offset = 0
+
+    def add(self, points):
+        """Aggregate the points, returns the points that are sampled to be written as they are"""
+        sampled = []
+        groups = self._groups
+        for point in points:
+            tags = point["tags"]
+            key = tuple(tags.get(tag, "") for tag in KEY_TAGS)
+            elapsed = point["fields"].get("elapsed", 0.0)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [1, {tags.get("username", "")}, elapsed, elapsed, elapsed]
+            else:
+                group[0] += 1
+                group[1].add(tags.get("username", ""))
+                group[2] += elapsed
+                if elapsed < group[3]:
+                    group[3] = elapsed
+                if elapsed > group[4]:
+                    group[4] = elapsed
+            if self.sample and random.random() < self.sample:
+                sampled.append(point)
+        self.aggregated += len(points)
+        return sampled
+
+    def due(self, now=None):
+        """Return the rollup points if the interval is over, otherwise an empty list"""
+        now = time.time() if now is None else now
+        if now < self._start + self.interval:
+            return []
+        return self.drain(now)
+
+    def drain(self, now=None):
+        """Return the rollup points of the current interval and start a new one"""
+        now = time.time() if now is None else now
+        groups, self._groups = self._groups, {}
+        timestamp = int(self._start * 10 ** 9) + self._offset()
+        self._start = self._window(now)
+        points = []
+        for key, (count, users, total, minimum, maximum) in groups.items():
+            points.append({
+                "measurement": self.measurement,
+                "tags": dict(zip(KEY_TAGS, key)),
+                "fields": {
+                    "count": count,
+                    "users": len(users),
+                    "elapsed_sum": total,
+                    "elapsed_mean": total / count,
+                    "elapsed_min": minimum,
+                    "elapsed_max": maximum,
+                },
+                "time": timestamp,
+            })
+        self.emitted += len(points)
+        return points
+
+    def stats(self):
+        """Return counters as well as the number of combinations in the current interval"""
+        return {"aggregated": self.aggregated, "emitted": self.emitted, "groups": len(self._groups)}
+
+    def _offset(self):
+        if self.offset is not None:
+            return self.offset
+        # the app is loaded before the workers are forked, so the offset is picked in the worker
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._random_offset = random.randrange(10 ** 9)
+        return self._random_offset
+
+    def _window(self, now):
+        # intervals are aligned, so the rollups of all writers can be summed per interval
+        return now - now % self.interval
@@ -0,0 +1,82 @@
+"""Classify a request uri into the resource it belongs to."""
+
+
+class Router:
+    """Prefix trie over path segments, built from all known resources. The longest known resource
+    that is a prefix of the path wins, this allows for resources such as geoserver/web. Fields that
+    are stored with the request are extracted based on a table of rules per resource."""
+
+    def __init__(self, resources, rules=None):
+        trie = {}
+        depth = 1
+        for resource in resources:
+            node = trie
+            segments = resource.split('/')
+            depth = max(depth, len(segments))
+            for segment in segments:
+                node = node.setdefault(segment, {})
+            # a None key marks the end of a resource, segments are always strings
+            node[None] = resource
+        self.root = self._freeze(trie)
+
+        self.rules = {}
+        for rule in rules or []:
+            depth = max(depth, rule["segment"] + 1)
+            self.rules.setdefault(rule["resource"], []).append(
+                (rule["field"], rule["segment"] + 1, rule.get("suffix"))
+            )
+
+        # most resources are a single segment without deeper resources, these are found with one
+        # lookup of the first segment, which also gives their rules
+        self.single = {segment: (entry[0], self.rules.get(entry[0]))
+                       for segment, entry in self.root.items() if entry[1] is None}
+
+        # only split as far as the trie and the rules look, the rest of the path stays in one piece
+        self.maxsplit = depth + 1
+
+    def classify(self, uri, fields):
+        """Return the resource for the uri and add the extracted fields"""
+        if uri[:1] != '/':
+            return 'NA'
+        if '?' in uri:
+            uri = uri.partition('?')[0]
+        pieces = uri.split('/', self.maxsplit)
+
+        # a top level page is either a known resource or part of the frontpage
+        if len(pieces) == 2:
+            entry = self.root.get(pieces[1])
+            if entry is not None and entry[0] is not None:
+                return entry[0]
+            return "frontpage"
+
+        single = self.single.get(pieces[1])
+        if single is not None:
+            resource, rules = single
+        else:
+            # walk the trie one segment at a time, for resources such as geoserver/web
+            resource = pieces[1]
+            entry = self.root.get(resource)
+            i = 2
+            while entry is not None:
+                if entry[0] is not None:
+                    resource = entry[0]
+                if entry[1] is None or i == len(pieces):
+                    break
+                entry = entry[1].get(pieces[i])
+                i += 1
+            rules = self.rules.get(resource)
+
+        if rules:
+            for field, index, suffix in rules:
+                if index < len(pieces) and (not suffix or uri.endswith(suffix)):
+                    fields[field] = pieces[index]
+        return resource
+
+    def _freeze(self, node):
+        """Turn every trie node into a (resource, children) tuple, children is None for a leaf"""
+        frozen = {}
+        for segment, child in node.items():
+            if segment is not None:
+                children = self._freeze(child)
+                frozen[segment] = (child.get(None), children or None)
+        return frozen
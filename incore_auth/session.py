@@ -0,0 +1,77 @@
+"""Signed session cookies, so a verified token does not need another RSA verification."""
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class SessionSigner:
+    """Issues and verifies session cookies holding the user information from a verified token. The
+    cookie is <payload>.<mac>, the mac is a keyed blake2b over the digest of the token and the payload,
+    so the cookie is only valid together with the token it was issued for. The key is derived from the
+    secret and the namespace (the fingerprint of the signing keys), when the keys change all sessions
+    become invalid. A session expires with its token."""
+
+    # claims kept in the session, with their short names in the payload
+    CLAIMS = (("preferred_username", "u"), ("given_name", "f"), ("family_name", "l"), ("name", "n"),
+              ("email", "m"), ("groups", "g"), ("roles", "r"), ("exp", "e"))
+
+    def __init__(self, secret, cookie_name="incore_session", secure=True):
+        self.secret = secret.encode("utf-8")
+        self.cookie_name = cookie_name
+        self.secure = secure
+        self.issued = 0
+        self.verified = 0
+        self.rejected = 0
+        self._key = b""
+        self.rotate("")
+
+    def rotate(self, namespace):
+        """Derive the key for the namespace, invalidating sessions issued with an other namespace"""
+        self._key = hashlib.blake2b(self.secret + b":" + namespace.encode("utf-8"), digest_size=32).digest()
+
+    def issue(self, digest, claims):
+        """Return the cookie value for the verified claims of the token with the digest"""
+        roles = claims["roles"] if "roles" in claims else claims.get("realm_access", {}).get("roles", [])
+        session = dict(claims, roles=roles)
+        payload = json.dumps({short: session[name] for name, short in self.CLAIMS if name in session},
+                             separators=(",", ":")).encode("utf-8")
+        self.issued += 1
+        return f"{b64encode(payload)}.{b64encode(self._mac(digest, payload))}"
+
+    def verify(self, value, digest):
+        """Return the claims from the cookie value if it was issued for this token and has not
+        expired, otherwise None"""
+        if not value:
+            return None
+        try:
+            payload, mac = value.split(".")
+            payload = b64decode(payload)
+            if not hmac.compare_digest(b64decode(mac), self._mac(digest, payload)):
+                self.rejected += 1
+                return None
+            session = json.loads(payload)
+        except ValueError:
+            self.rejected += 1
+            return None
+        if session.get("e", 0) <= time.time():
+            self.rejected += 1
+            return None
+        self.verified += 1
+        return {name: session[short] for name, short in self.CLAIMS if short in session}
+
+    def stats(self):
+        """Return the number of issued, verified and rejected sessions"""
+        return {"issued": self.issued, "verified": self.verified, "rejected": self.rejected}
+
+    def _mac(self, digest, payload):
+        return hashlib.blake2b(digest + payload, key=self._key, digest_size=16).digest()
@@ -0,0 +1,153 @@
+"""Key/value state with expiry, either kept in process or shared by all workers using redis."""
+import heapq
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger("app.sharedstate")
+
+
+class LocalState:
+    """State kept in this process. The expiry times are kept in a heap, so expired keys are removed
+    from the front in O(log n) whatever their ttl. At most maxsize keys are kept, when full the keys
+    that expire first are removed."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, key, value, ttl):
+        """Store the value if the key does not exist, returns True if the value was stored"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if key in self._entries:
+                return False
+            self._store(key, value, now + ttl)
+            return True
+
+    def set(self, key, value, ttl):
+        """Store the value, replacing an existing value"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._store(key, value, now + ttl)
+
+    def get(self, key):
+        """Return the value for the key, or None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _expire(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            self._pop()
+
+    def _pop(self):
+        # the heap may hold entries of keys that were replaced or deleted since, these are skipped
+        expires, key = heapq.heappop(self._heap)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == expires:
+            del self._entries[key]
+
+    def _store(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        heapq.heappush(self._heap, (expires, key))
+        while len(self._entries) > self.maxsize:
+            self._pop()
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(expires, key) for key, (expires, _) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+
+class RedisState:
+    """State shared by all workers (and nodes) using redis, or anything speaking the redis protocol.
+    Values are stored as json. If redis can not be reached the state falls back to a LocalState for
+    retry_interval seconds, so keys are still deduplicated within this worker and requests don't wait
+    for redis to time out. Errors are logged at most once every log_interval seconds."""
+
+    def __init__(self, url, prefix="incore_auth:", timeout=0.5, retry_interval=5, log_interval=60,
+                 maxsize=10000):
+        import redis
+        self.prefix = prefix
+        self.retry_interval = retry_interval
+        self.log_interval = log_interval
+        self.fallback = LocalState(maxsize=maxsize)
+        self.errors = 0
+        self._redis = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._down_until = 0
+        self._next_log = 0
+
+    def add(self, key, value, ttl):
+        if self.available():
+            try:
+                return bool(self._redis.set(self.prefix + key, json.dumps(value), nx=True, px=int(ttl * 1000)))
+            except Exception as e:
+                self._failed(e)
+        return self.fallback.add(key, value, ttl)
+
+    def set(self, key, value, ttl):
+        if self.available():
+            try:
+                self._redis.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000))
+                return
+            except Exception as e:
+                self._failed(e)
+        self.fallback.set(key, value, ttl)
+
+    def get(self, key):
+        if self.available():
+            try:
+                value = self._redis.get(self.prefix + key)
+                return None if value is None else json.loads(value)
+            except Exception as e:
+                self._failed(e)
+        return self.fallback.get(key)
+
+    def delete(self, key):
+        self.fallback.delete(key)
+        if self.available():
+            try:
+                self._redis.delete(self.prefix + key)
+            except Exception as e:
+                self._failed(e)
+
+    def size(self):
+        if self.available():
+            try:
+                return self._redis.dbsize()
+            except Exception as e:
+                self._failed(e)
+        return self.fallback.size()
+
+    def available(self):
+        """Return True unless redis failed within the last retry_interval seconds"""
+        return time.monotonic() >= self._down_until
+
+    def _failed(self, error):
+        now = time.monotonic()
+        self.errors += 1
+        self._down_until = now + self.retry_interval
+        if now >= self._next_log:
+            self._next_log = now + self.log_interval
+            logger.error(f"Could not reach redis ({error}), using state local to this worker, "
+                         f"{self.errors} errors so far")
+
+
+def create_state(url=None, maxsize=10000):
+    """Return shared state for redis:// urls, otherwise state local to this process"""
+    if url:
+        return RedisState(url)
+    return LocalState(maxsize=maxsize)
@@ -0,0 +1,269 @@
+"""Keep analytics on disk while influxdb is unavailable, and replay them once it is back."""
+import logging
+import os
+import threading
+import time
+
+from lineprotocol import encode
+
+logger = logging.getLogger("app.spool")
+
+
+def retryable(error):
+    """Return True if a failed write may succeed later, this is the case for errors without an http
+    status (connection errors and timeouts), 5xx, 429, and 401, 403 and 404 that are fixed by
+    configuring influxdb. Other 4xx errors reject the data itself."""
+    status = getattr(error, "status", None)
+    if not isinstance(status, int) or status < 400:
+        return True
+    return status >= 500 or status in (401, 403, 404, 429)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Spool:
+    """Append-only segment files of line protocol in a directory that can be shared by all workers. A
+    worker appends to its own open segment (spool-<pid>-<seq>.open), which is closed (renamed to .lp)
+    once it reaches segment_size bytes or when it is replayed. Closed segments are claimed for replay
+    by renaming them. When all segments together exceed max_bytes the oldest closed segments are
+    removed."""
+
+    def __init__(self, directory, segment_size=8*1024*1024, max_bytes=512*1024*1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.appended = 0
+        self.discarded = 0
+        self._file = None
+        self._size = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, data):
+        """Append line protocol (bytes, every line ending in a newline), the data is flushed to the
+        file so it is not lost if the worker dies, the segment is only fsynced when it is closed"""
+        with self._lock:
+            if self._file is None:
+                self._seq += 1
+                path = os.path.join(self.directory, f"spool-{os.getpid()}-{self._seq:06d}.open")
+                self._file = open(path, "ab")
+                self._size = 0
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self.appended += data.count(b"\n")
+            if self._size >= self.segment_size:
+                self._close()
+        if self._file is None:
+            self.enforce_limit()
+
+    def close_segment(self):
+        """Close the open segment so it can be replayed"""
+        with self._lock:
+            if self._file is not None:
+                self._close()
+
+    def pending(self):
+        """Return True if anything is waiting to be replayed, including the open segment"""
+        return self._file is not None or bool(self._segments(".lp"))
+
+    def claim(self):
+        """Claim the oldest closed segment for replay, returns its path or None"""
+        for name in self._segments(".lp"):
+            path = os.path.join(self.directory, name)
+            claimed = f"{path}.replay-{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+                return claimed
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+        return None
+
+    def release(self, claimed, done):
+        """Remove a replayed segment, or give it back if the replay failed"""
+        if done:
+            os.remove(claimed)
+        else:
+            os.rename(claimed, claimed.rsplit(".replay-", 1)[0])
+
+    def recover(self):
+        """Close the segments of workers that are gone, so they are replayed as well"""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".open"):
+                pid = int(name.split("-")[1])
+                if pid != os.getpid() and not pid_alive(pid):
+                    os.rename(path, path[:-len(".open")] + ".lp")
+            elif ".lp.replay-" in name:
+                pid = int(name.rsplit("-", 1)[1])
+                if pid != os.getpid() and not pid_alive(pid):
+                    os.rename(path, path.rsplit(".replay-", 1)[0])
+
+    def enforce_limit(self):
+        """Remove the oldest closed segments while the spool is larger than max_bytes"""
+        segments = self._segments(".lp")
+        total = self.stats()["bytes"]
+        while total > self.max_bytes and segments:
+            path = os.path.join(self.directory, segments.pop(0))
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.discarded += 1
+            logger.error(f"Spool is larger than {self.max_bytes} bytes, removed {path}")
+
+    def stats(self):
+        """Return counters as well as the size of the spool directory"""
+        size = 0
+        for name in os.listdir(self.directory):
+            try:
+                size += os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        return {"appended": self.appended, "discarded": self.discarded, "bytes": size}
+
+    def _close(self):
+        # make sure the segment is on disk before it can be replayed and removed
+        os.fsync(self._file.fileno())
+        self._file.close()
+        path = self._file.name
+        os.rename(path, path[:-len(".open")] + ".lp")
+        self._file = None
+
+    def _segments(self, suffix):
+        # oldest first, segments of different workers are ordered by when they were last written
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(suffix):
+                try:
+                    segments.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+                except FileNotFoundError:
+                    pass
+        return [name for _, name in sorted(segments)]
+
+
+class SpoolingSink:
+    """Wraps the influxdb sink. Points are written to the sink while it works, once a write fails all
+    points go to the spool without trying the sink, so the analytics thread never waits for an
+    unavailable influxdb. A background thread replays the spool at most rate lines per second, every
+    retry_interval seconds, and switches back to the sink once the spool is empty. Only retryable
+    errors are spooled, points that influxdb rejects are dropped, also when replaying."""
+
+    def __init__(self, sink, spool, rate=5000, chunk_size=500, retry_interval=10):
+        self.sink = sink
+        self.spool = spool
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.retry_interval = retry_interval
+        self.healthy = True
+        self.spooled = 0
+        self.replayed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __call__(self, points):
+        with self._lock:
+            healthy = self.healthy
+        if healthy:
+            try:
+                self.sink(points)
+                return
+            except Exception as e:
+                # the analytics writer logs the error and counts the points as failed
+                if not retryable(e):
+                    raise
+                logger.exception(f"Could not write to influxdb, spooling to {self.spool.directory}")
+        self._spool(points)
+
+    def start(self):
+        """Start the background replayer"""
+        if self._thread:
+            return
+        self.spool.recover()
+        if self.spool.pending():
+            self.healthy = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        """Return counters, the spool counters and if the sink is used"""
+        stats = self.spool.stats()
+        stats.update({"healthy": self.healthy, "spooled": self.spooled, "replayed": self.replayed,
+                      "rejected": self.rejected})
+        return stats
+
+    def replay(self):
+        """Replay the spool, returns True if it is empty afterwards and the sink is used again"""
+        while True:
+            claimed = self.spool.claim()
+            if claimed is None:
+                # switch back to the sink, unless points were spooled meanwhile
+                with self._lock:
+                    if not self.spool.pending():
+                        self.healthy = True
+                        logger.info("Replayed the spool, writing to influxdb again")
+                        return True
+                    self.spool.close_segment()
+                continue
+            done = False
+            try:
+                done = self._replay(claimed)
+            finally:
+                self.spool.release(claimed, done)
+            if not done:
+                return False
+
+    def _spool(self, points):
+        # points are either a payload of line protocol or datapoints
+        if isinstance(points, bytes):
+            data = points if points.endswith(b"\n") else points + b"\n"
+        else:
+            data = "".join(encode(point) + "\n" for point in points).encode("utf-8")
+        with self._lock:
+            self.healthy = False
+            self.spool.append(data)
+            self.spooled += data.count(b"\n")
+
+    def _replay(self, claimed):
+        with open(claimed, "rb") as f:
+            lines = f.read().splitlines()
+        # a segment is replayed from the start if it fails halfway, influxdb overwrites duplicates
+        for start in range(0, len(lines), self.chunk_size):
+            chunk = lines[start:start + self.chunk_size]
+            before = time.monotonic()
+            try:
+                self.sink(b"\n".join(chunk))
+                self.replayed += len(chunk)
+            except Exception as e:
+                if retryable(e):
+                    logger.warning(f"Could not replay {claimed}, will try again in {self.retry_interval} seconds")
+                    return False
+                # trying again gives the same answer, so the chunk is dropped to get to the rest
+                self.rejected += len(chunk)
+                logger.error(f"Influxdb rejected {len(chunk)} lines of {claimed}, dropped them: {e}")
+            wait = len(chunk) / self.rate - (time.monotonic() - before)
+            if wait > 0:
+                time.sleep(wait)
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.retry_interval)
+            if not self.healthy:
+                try:
+                    self.replay()
+                except Exception:
+                    logger.exception("Could not replay the spool")
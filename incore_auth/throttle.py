@@ -0,0 +1,46 @@
+"""Decide which requests are tracked, based on per resource rules from config.json."""
+import random
+
+from sharedstate import LocalState
+
+
+class Rule:
+    """Tracking rule for a single resource. Only uris ending in one of the suffixes are tracked, each
+    key (user) is tracked at most once per interval seconds and only a sample fraction is kept."""
+
+    __slots__ = ("suffixes", "interval", "sample")
+
+    def __init__(self, suffixes=None, interval=0, sample=1.0):
+        self.suffixes = tuple(suffixes) if suffixes else None
+        self.interval = interval
+        self.sample = sample
+
+
+def compile_rules(rules):
+    """Turn the rules, given as {resource: {suffixes, interval, sample}}, into {resource: Rule}"""
+    return {resource: Rule(**rule) for resource, rule in rules.items()}
+
+
+class Throttle:
+    """Applies the tracking rules, which are part of the policy. When a key is tracked it is added to
+    the state with the interval as ttl, while it exists the key is not tracked again. The state can
+    be shared by all workers."""
+
+    def __init__(self, state=None):
+        self.state = state or LocalState()
+
+    def wanted(self, rule, uri):
+        """Return True if the request passes the suffix and sample rules, this does not need the user"""
+        if rule is None:
+            return True
+        if rule.suffixes and not uri.endswith(rule.suffixes):
+            return False
+        if rule.sample < 1.0 and random.random() >= rule.sample:
+            return False
+        return True
+
+    def allow(self, resource, rule, key):
+        """Return True if the key was not tracked for this resource within the interval"""
+        if rule is None or not rule.interval:
+            return True
+        return self.state.add(f"throttle:{resource}:{key}", 1, rule.interval)
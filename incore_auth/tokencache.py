@@ -0,0 +1,138 @@
+"""Cache of verified token claims, keyed by a digest of the raw token."""
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+
+from cachetools import TTLCache
+
+
+def token_digest(token):
+    """Return a short digest of the raw token, used as cache key"""
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+
+
+class ClaimsCache:
+    """Bounded LRU cache of decoded claims. Every entry expires at the exp claim of its token, the
+    whole cache is cleared when the signing key rotates. The response headers built from the claims
+    are kept with the entry, so they are only built once per token. If shared state is given, claims
+    verified by any worker are found there, the keys are namespaced by the fingerprint of the signing
+    keys."""
+
+    def __init__(self, maxsize=1024, shared=None):
+        self.maxsize = maxsize
+        self.shared = shared
+        self.namespace = ""
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        """Return the claims cached in this worker for the digest, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                expires, claims, _ = entry
+                if expires > time.time():
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return claims
+                del self._entries[digest]
+            self.misses += 1
+        return None
+
+    def get_shared(self, digest):
+        """Return the claims verified by any worker from the shared state, or None. This is a round
+        trip to the shared state, so it is only done after get() missed and the token was not
+        rejected. Claims that are found are cached in this worker from then on."""
+        if not self.shared:
+            return None
+        claims = self.shared.get(self._shared_key(digest))
+        found = claims is not None and self._store(digest, claims)
+        with self._lock:
+            if found:
+                self.shared_hits += 1
+            else:
+                self.shared_misses += 1
+        return claims if found else None
+
+    def put(self, digest, claims):
+        """Store the claims, tokens without an exp claim are never cached"""
+        ttl = self._store(digest, claims)
+        if ttl and self.shared:
+            self.shared.set(self._shared_key(digest), claims, ttl)
+
+    def headers(self, digest):
+        """Return the response headers stored with the claims, or None"""
+        entry = self._entries.get(digest)
+        return entry[2] if entry is not None else None
+
+    def set_headers(self, digest, headers):
+        """Store the response headers with the claims, if the claims are cached"""
+        entry = self._entries.get(digest)
+        if entry is not None:
+            entry[2] = headers
+
+    def clear(self, namespace=""):
+        """Remove all entries, called with the new key fingerprint when the signing key changes"""
+        with self._lock:
+            self.namespace = namespace
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit and miss counters, of this worker and the shared state, as well as the current size"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "shared_hits": self.shared_hits,
+                    "shared_misses": self.shared_misses, "size": len(self._entries)}
+
+    def _store(self, digest, claims):
+        expires = claims.get("exp")
+        if not isinstance(expires, (int, float)) or expires <= time.time():
+            return 0
+        with self._lock:
+            self._entries[digest] = [expires, claims, None]
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return expires - time.time()
+
+    def _shared_key(self, digest):
+        return f"claims:{self.namespace}:{digest.hex()}"
+
+
+class RejectionCache:
+    """Bounded cache of tokens that failed verification and the reason why, kept for a short ttl so
+    clients retrying with a bad token don't cause a signature check on every request."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.hits = 0
+        self.misses = 0
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        """Return the reason the token was rejected, or None"""
+        with self._lock:
+            reason = self._entries.get(digest)
+            if reason is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return reason
+
+    def put(self, digest, reason):
+        with self._lock:
+            self._entries[digest] = reason
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit and miss counters as well as the current size"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}